@@ -1,13 +1,16 @@
-from flask import Flask, jsonify, request
+import sys, os, hmac
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 import werkzeug
-from chalicelib.util import util
-from chalicelib.api import accounts, users, idps
+from bson.errors import InvalidId
+from chalicelib.util import util, indexes, migrations, keypool, stats, cascade, ratelimit, mail, metrics, errors
+from chalicelib.api import accounts, users, idps, batch
 
 app = Flask(__name__)
 CORS(app)
-limiter = Limiter(app, default_limits=['20 per minute'], key_func=util.limit_by_user)
+limiter = Limiter(app, default_limits=['20 per minute'], key_func=util.limit_by_user, storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'ssotools-mongo://'), enabled=os.environ.get('RATELIMIT_ENABLED', 'true').lower() == 'true')
+metrics.init_app(app)
 
 @app.errorhandler(werkzeug.exceptions.TooManyRequests)
 def handle_429(e):
@@ -15,6 +18,10 @@ def handle_429(e):
 @app.errorhandler(werkzeug.exceptions.BadRequest)
 def handle_bad_request(e):
   return jsonify({'message': e.description}), 400
+@app.errorhandler(InvalidId)
+def handle_invalid_id(e):
+  # Raised by ObjectId() for malformed ids in the path, as in batch.call
+  return jsonify({'message': str(e)}), 400
 @app.errorhandler(werkzeug.exceptions.Unauthorized)
 def handle_not_authorized(e):
   return jsonify({'message': e.description}), 401
@@ -24,6 +31,67 @@ def handle_forbidden(e):
 @app.errorhandler(werkzeug.exceptions.NotFound)
 def handle_not_found(e):
   return jsonify({'message': e.description}), 404
+@app.errorhandler(werkzeug.exceptions.Conflict)
+def handle_conflict(e):
+  return jsonify({'message': e.description}), 409
+@app.errorhandler(werkzeug.exceptions.ServiceUnavailable)
+def handle_service_unavailable(e):
+  return jsonify({'message': e.description}), 503, {'Retry-After': '5'}
+
+# COMMANDS
+
+@app.cli.command('migrate')
+def migrate_command():
+  print(util.jsonify(migrations.run()))
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+  for change in indexes.ensure_indexes(): print(change)
+
+@app.cli.command('index-drift')
+def index_drift_command():
+  report = indexes.drift_report()
+  print(util.jsonify(report))
+  if report: sys.exit(1)
+
+@app.cli.command('refill-key-pool')
+def refill_key_pool_command():
+  print('Generated {0} keys'.format(keypool.refill()))
+  print(util.jsonify(keypool.stats()))
+
+@app.cli.command('rollup-stats')
+def rollup_stats_command():
+  print(util.jsonify(stats.rollup()))
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+  print('Completed {0} jobs'.format(cascade.run_pending()))
+
+@app.cli.command('sweep-orphans')
+def sweep_orphans_command():
+  result = cascade.sweep_orphans()
+  print(util.jsonify(result))
+  if result['job']: cascade.run_pending()
+
+@app.cli.command('deliver-mail')
+def deliver_mail_command():
+  mail.run_worker()
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+  failures = indexes.check_query_plans()
+  for failure in failures:
+    print('COLLSCAN on {0}: {1}'.format(failure['collection'], failure['query']))
+  if failures: sys.exit(1)
+
+# METRICS
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics_route():
+  token = os.environ.get('METRICS_TOKEN')
+  if token and not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token): raise errors.Unauthorized('A valid metrics token is required')
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # ACCOUNTS
 
@@ -72,6 +140,13 @@ def users_me():
 def user_route(id):
   return util.jsonify(users.update(util.get_user(), id, request.json))
 
+# BATCH
+
+@app.route('/batch', methods=['POST'])
+@limiter.limit(batch.rate_limit, key_func=util.limit_by_user, cost=batch.cost, methods=['POST'])
+def batch_route():
+  return util.jsonify(batch.run(util.get_user(required=False), request.json))
+
 # IDPs
 
 @app.route('/idps', methods=['GET', 'POST'])
@@ -80,21 +155,30 @@ def idps_route():
     return util.jsonify(idps.create(util.get_user(required=False), request.json))
   if request.method == 'GET':
     params = request.args or {}
-    return util.jsonify(idps.get(util.get_user(required=False), params.get('include')))
+    result = idps.get(util.get_user(required=False), params.get('include'))
+    tag = util.etag('idps', [[idp['_id'], idp.get('version', 0)] for idp in result['idps']])
+    return util.conditional(tag, lambda: util.jsonify(result))
 
 @app.route('/idps/<id>', methods=['GET', 'PUT', 'DELETE'])
 def idp_route(id):
   if request.method == 'GET':
-    return util.jsonify(idps.get_one(util.get_user(required=False), id))
+    user = util.get_user(required=False)
+    return util.conditional(idps.get_etag(user, id, 'idp'), lambda: util.jsonify(idps.get_one(user, id)))
   if request.method == 'PUT':
     return util.jsonify(idps.update(util.get_user(required=False), id, request.json))
   if request.method == 'DELETE':
     return util.jsonify(idps.delete(util.get_user(required=False), id))
 
+@app.route('/idps/<id>/snapshot', methods=['GET'])
+def idp_snapshot_route(id):
+  tag, build = idps.get_snapshot(util.get_user(required=False), id, request.args)
+  return util.conditional(tag, lambda: util.jsonify(build()))
+
 @app.route('/idps/<id>/sps', methods=['GET', 'POST'])
 def idp_sps_route(id):
   if request.method == 'GET':
-    return util.jsonify(idps.get_sps(util.get_user(required=False), id))
+    user = util.get_user(required=False)
+    return util.conditional(idps.get_etag(user, id, 'sps', request.args.to_dict()), lambda: util.jsonify(idps.get_sps(user, id, request.args)))
   if request.method == 'POST':
     return util.jsonify(idps.create_sp(util.get_user(required=False), id, request.json))
 
@@ -108,10 +192,17 @@ def idp_sp_route(id, sp_id):
 @app.route('/idps/<id>/users', methods=['GET', 'POST'])
 def idp_users_route(id):
   if request.method == 'GET':
-    return util.jsonify(idps.get_users(util.get_user(required=False), id))
+    user = util.get_user(required=False)
+    return util.conditional(idps.get_etag(user, id, 'users', request.args.to_dict()), lambda: Response(util.jsonify_stream(idps.get_users(user, id, request.args)), mimetype='application/json'))
   if request.method == 'POST':
     return util.jsonify(idps.create_user(util.get_user(required=False), id, request.json))
 
+@app.route('/idps/<id>/users/import', methods=['POST'])
+@limiter.limit('5 per minute', key_func=util.limit_by_user, methods=['POST'])
+def idp_users_import_route(id):
+  results = idps.import_users(util.get_user(required=False), id, request.stream, request.content_type)
+  return Response(stream_with_context(util.ndjson(results)), mimetype='application/x-ndjson')
+
 @app.route('/idps/<id>/users/<user_id>', methods=['PUT', 'DELETE'])
 def idp_user_route(id, user_id):
   if request.method == 'DELETE':
@@ -122,7 +213,8 @@ def idp_user_route(id, user_id):
 @app.route('/idps/<id>/attributes', methods=['GET', 'POST'])
 def idp_attributes_route(id):
   if request.method == 'GET':
-    return util.jsonify(idps.get_attributes(util.get_user(required=False), id))
+    user = util.get_user(required=False)
+    return util.conditional(idps.get_etag(user, id, 'attributes', request.args.to_dict()), lambda: util.jsonify(idps.get_attributes(user, id, request.args)))
   if request.method == 'POST':
     return util.jsonify(idps.create_attribute(util.get_user(required=False), id, request.json))
 
@@ -135,8 +227,25 @@ def idp_attribute_route(id, attr_id):
 
 @app.route('/idps/<id>/saml2/logs', methods=['GET'])
 def idp_saml_logs_route(id):
-  return util.jsonify(idps.get_logs(util.get_user(required=False), id))
+  user = util.get_user(required=False)
+  tag = idps.get_logs_etag(user, id, ['saml2'], request.args.to_dict())
+  return util.conditional(tag, lambda: util.jsonify(idps.get_logs(user, id, request.args)))
+
+@app.route('/idps/<id>/stats', methods=['GET'])
+def idp_stats_route(id):
+  return util.jsonify(idps.get_stats(util.get_user(required=False), id, request.args))
+
+@app.route('/idps/<id>/<any(saml2, oauth2):kind>/logs/export', methods=['GET'])
+def idp_logs_export_route(id, kind):
+  logs = util.ndjson(idps.export_logs(util.get_user(required=False), id, kind, request.args))
+  headers = {'Content-Disposition': 'attachment; filename="{0}-{1}-logs.ndjson"'.format(id, kind), 'Vary': 'Accept-Encoding'}
+  if 'gzip' in request.headers.get('Accept-Encoding', ''):
+    logs = util.gzip_stream(logs)
+    headers['Content-Encoding'] = 'gzip'
+  return Response(logs, mimetype='application/x-ndjson', headers=headers)
 
 @app.route('/idps/<id>/oauth2/logs', methods=['GET'])
 def idp_oauth_logs_route(id):
-  return util.jsonify(idps.get_oauth_logs(util.get_user(required=False), id))
\ No newline at end of file
+  user = util.get_user(required=False)
+  tag = idps.get_logs_etag(user, id, ['oauth2'], request.args.to_dict())
+  return util.conditional(tag, lambda: util.jsonify(idps.get_oauth_logs(user, id, request.args)))
\ No newline at end of file
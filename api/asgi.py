@@ -0,0 +1,185 @@
+# ASGI entry point: serve with `uvicorn asgi:app` or `gunicorn -k uvicorn.workers.UvicornWorker asgi:app`.
+# The read-heavy routes, login and IdP creation run natively on motor. Every other route is passed through to the Flask app in app.py.
+import os, json, time, asyncio
+from urllib.parse import parse_qsl
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.routing import Map, Rule
+from werkzeug.datastructures import MultiDict, Headers
+from werkzeug.exceptions import HTTPException, NotFound, MethodNotAllowed
+from bson.errors import InvalidId
+from werkzeug.http import parse_etags
+from flask_cors.core import get_cors_options, get_cors_headers
+from limits import parse as parse_limit
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+# ratelimit is imported to register the ssotools-mongo limits storage
+from chalicelib.util import util, errors, serialization, metrics, ratelimit, mail, async_database
+from chalicelib.api import accounts, async_accounts, async_idps, users
+import app as wsgi
+
+flask_app = WsgiToAsgi(wsgi.app)
+# The Flask app's CORS settings, so both entry points send the same headers
+cors_options = get_cors_options(wsgi.app)
+limiter = FixedWindowRateLimiter(storage_from_string(os.environ.get('RATELIMIT_STORAGE_URI', 'ssotools-mongo://')))
+default_limit = parse_limit('20 per minute')
+client_limit = parse_limit('5 per minute')
+
+class Request:
+  def __init__(self, scope, body):
+    self.method = scope['method']
+    self.path = scope['path']
+    self.headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+    self.args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+    self.remote_addr = scope['client'][0] if scope.get('client') else '127.0.0.1'
+    self.body = body
+    self.user = None
+
+  @property
+  def json(self):
+    try:
+      return json.loads(self.body) if self.body else None
+    except ValueError:
+      raise errors.BadRequest('The request body is not valid JSON')
+
+  async def get_user(self, required=True):
+    header = self.headers.get('authorization')
+    if not header and required: raise errors.Unauthorized('This resource requires authentication')
+    if not header: return None
+    if self.user is None: self.user = await async_accounts.get_user_context(header.replace('Bearer ', ''), self.method not in ('GET', 'HEAD'))
+    if self.user is None and required: raise errors.Unauthorized('Invalid token')
+    return self.user
+
+  def limit_key_by_user(self):
+    subject = accounts.get_token_subject(self.headers.get('authorization', '').replace('Bearer ', ''))
+    return subject or self.remote_addr
+
+  def limit_key_by_client(self):
+    data = self.json if self.headers.get('content-type', '').startswith('application/json') else None
+    if isinstance(data, dict):
+      if data.get('email'): return data['email']
+      if data.get('token'): return data['token']
+    return self.remote_addr
+
+async def check_limit(limit, key, endpoint):
+  if not wsgi.limiter.enabled: return
+  # The limiter's storage is synchronous, so hits are recorded off the event loop
+  if not await asyncio.to_thread(limiter.hit, limit, 'asgi', endpoint, key):
+    raise errors.TooManyRequests(str(limit))
+
+async def conditional(request, tag, build):
+  # Like util.conditional: the body is only built when If-None-Match doesn't match
+  headers = {'ETag': '"{0}"'.format(tag)}
+  if parse_etags(request.headers.get('if-none-match')).contains(tag): return 304, None, headers
+  return 200, await build(), headers
+
+# Routes
+
+async def login(request):
+  await check_limit(client_limit, request.limit_key_by_client(), 'login')
+  return 200, await async_accounts.login(request.json), {}
+
+async def users_me(request):
+  return 200, users.me(await request.get_user()), {}
+
+async def idps_route(request):
+  user = await request.get_user(required=False)
+  if request.method == 'POST': return 200, await async_idps.create(user, request.json), {}
+  result = await async_idps.get(user, request.args.get('include'))
+  tag = util.etag('idps', [[idp['_id'], idp.get('version', 0)] for idp in result['idps']])
+  if parse_etags(request.headers.get('if-none-match')).contains(tag): return 304, None, {'ETag': '"{0}"'.format(tag)}
+  return 200, result, {'ETag': '"{0}"'.format(tag)}
+
+async def idp_route(request, id):
+  user = await request.get_user(required=False)
+  return await conditional(request, await async_idps.get_etag(user, id, 'idp'), lambda: async_idps.get_one(user, id))
+
+async def idp_snapshot_route(request, id):
+  tag, build = await async_idps.get_snapshot(await request.get_user(required=False), id, request.args)
+  return await conditional(request, tag, build)
+
+def children_route(resource, loader):
+  async def route(request, id):
+    user = await request.get_user(required=False)
+    return await conditional(request, await async_idps.get_etag(user, id, resource, request.args.to_dict()), lambda: loader(user, id, request.args))
+  return route
+
+def logs_route(kind, loader):
+  async def route(request, id):
+    user = await request.get_user(required=False)
+    tag = await async_idps.get_logs_etag(user, id, [kind], request.args.to_dict())
+    return await conditional(request, tag, lambda: loader(user, id, request.args))
+  return route
+
+async def idp_stats_route(request, id):
+  return 200, await async_idps.get_stats(await request.get_user(required=False), id, request.args), {}
+
+routes = Map([
+  Rule('/accounts/sessions', methods=['POST'], endpoint=login),
+  Rule('/users/me', methods=['GET'], endpoint=users_me),
+  Rule('/idps', methods=['GET', 'POST'], endpoint=idps_route),
+  Rule('/idps/<id>', methods=['GET'], endpoint=idp_route),
+  Rule('/idps/<id>/snapshot', methods=['GET'], endpoint=idp_snapshot_route),
+  Rule('/idps/<id>/sps', methods=['GET'], endpoint=children_route('sps', async_idps.get_sps)),
+  Rule('/idps/<id>/users', methods=['GET'], endpoint=children_route('users', async_idps.get_users)),
+  Rule('/idps/<id>/attributes', methods=['GET'], endpoint=children_route('attributes', async_idps.get_attributes)),
+  Rule('/idps/<id>/saml2/logs', methods=['GET'], endpoint=logs_route('saml2', async_idps.get_logs)),
+  Rule('/idps/<id>/oauth2/logs', methods=['GET'], endpoint=logs_route('oauth2', async_idps.get_oauth_logs)),
+  Rule('/idps/<id>/stats', methods=['GET'], endpoint=idp_stats_route),
+])
+
+def error_response(e):
+  if isinstance(e, errors.TooManyRequests):
+    body = {'message': 'You\'re making too many requests. Please wait for a few minutes before trying again.', 'Allowed limit': e.description}
+  else: body = {'message': e.description}
+  return e.code, body, {'Retry-After': '5'} if e.code == 503 else {}
+
+async def read_body(receive):
+  body = b''
+  while True:
+    message = await receive()
+    body += message.get('body', b'')
+    if not message.get('more_body'): return body
+
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      if os.environ.get('MONGO_WARM_UP', 'true').lower() == 'true': await async_database.warm_up()
+      if mail.background_delivery: mail.start_worker()
+      metrics.start_writer()
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      async_database.close()
+      return await send({'type': 'lifespan.shutdown.complete'})
+
+async def app(scope, receive, send):
+  if scope['type'] == 'lifespan': return await lifespan(receive, send)
+  if scope['type'] != 'http': return await flask_app(scope, receive, send)
+  try:
+    rule, view_args = routes.bind('').match(scope['path'], method=scope['method'], return_rule=True)
+  except (NotFound, MethodNotAllowed):
+    return await flask_app(scope, receive, send)
+
+  start = time.perf_counter()
+  request = Request(scope, await read_body(receive))
+  try:
+    # As with Flask-Limiter, routes without their own limit get the default limit
+    if rule.endpoint is not login: await check_limit(default_limit, request.limit_key_by_user(), rule.rule)
+    status, body, headers = await rule.endpoint(request, **view_args)
+  except HTTPException as e:
+    status, body, headers = error_response(e)
+  except InvalidId as e:
+    # Raised by ObjectId() for malformed ids in the path, as in batch.call
+    status, body, headers = error_response(errors.BadRequest(str(e)))
+  except Exception as e:
+    print(e)
+    status, body, headers = error_response(errors.InternalServerError())
+  payload = serialization.dumps(body).encode('utf-8') if body is not None else b''
+  headers = dict(headers, **{'Content-Type': 'application/json'})
+  headers.update(get_cors_headers(cors_options, Headers(request.headers), request.method).items())
+  labels = {'route': rule.rule, 'method': request.method}
+  metrics.histogram('http_request_duration_seconds', labels=labels).observe(time.perf_counter() - start)
+  metrics.counter('http_requests_total', dict(labels, status=str(status))).inc()
+  await send({'type': 'http.response.start', 'status': status, 'headers': [(key.lower().encode('latin-1'), str(value).encode('latin-1')) for key, value in headers.items()] + [(b'content-length', str(len(payload)).encode('latin-1'))]})
+  # HEAD responses keep the GET response's headers and length, without the body
+  await send({'type': 'http.response.body', 'body': payload if request.method != 'HEAD' else b''})
@@ -0,0 +1,268 @@
+# Drives every route in app.py in-process at a fixed concurrency and reports latency percentiles, throughput and Mongo operations per request.
+# Run from the api directory with: python -m benchmarks.endpoints [--mongo-url mongodb://localhost:27017]
+# Without --mongo-url the app runs against mongomock (pip install mongomock), with database operations serialized by a lock.
+# Compare two result files with: python -m benchmarks.endpoints --compare old.json new.json
+import os, io, json, time, datetime, threading, argparse, subprocess, warnings
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('JWT_SECRET', 'benchmark-secret')
+os.environ.setdefault('MONGO_DATABASE', 'ssotools_benchmark')
+os.environ.setdefault('RATELIMIT_STORAGE_URI', 'memory://')
+os.environ.setdefault('MAIL_BACKGROUND_DELIVERY', 'false')
+os.environ.setdefault('KEY_POOL_BACKGROUND_REFILL', 'false')
+
+import pymongo
+from pymongo import monitoring
+from bson.objectid import ObjectId
+
+ignored_commands = {'isMaster', 'ismaster', 'hello', 'ping', 'endSessions', 'buildInfo', 'saslStart', 'saslContinue'}
+collection_methods = ['aggregate', 'bulk_write', 'count_documents', 'delete_many', 'delete_one', 'distinct', 'find', 'find_one', 'find_one_and_delete', 'find_one_and_update', 'index_information', 'insert', 'insert_many', 'insert_one', 'remove', 'update', 'update_many', 'update_one']
+
+class OperationCounter(monitoring.CommandListener):
+  def __init__(self):
+    self.count = 0
+    self.lock = threading.Lock()
+  def increment(self):
+    with self.lock: self.count += 1
+  def started(self, event):
+    if event.command_name not in ignored_commands: self.increment()
+  def succeeded(self, event): pass
+  def failed(self, event): pass
+
+def connect(mongo_url, counter):
+  from chalicelib.util import database
+  if mongo_url:
+    client = pymongo.MongoClient(mongo_url, event_listeners=[counter])
+    client.drop_database(os.environ['MONGO_DATABASE'])
+    database.use(client[os.environ['MONGO_DATABASE']])
+    return 'mongod'
+  import mongomock
+  # mongomock is not thread-safe and has no command monitoring, so each public collection call is counted once and run under a lock
+  lock = threading.RLock()
+  local = threading.local()
+  def counted(method):
+    def wrapper(*args, **kwargs):
+      with lock:
+        outer = not getattr(local, 'depth', 0)
+        if outer: counter.increment()
+        local.depth = getattr(local, 'depth', 0) + 1
+        try:
+          result = method(*args, **kwargs)
+          return iter(list(result)) if outer and isinstance(result, mongomock.command_cursor.CommandCursor) else result
+        finally: local.depth -= 1
+    return wrapper
+  for name in collection_methods:
+    setattr(mongomock.collection.Collection, name, counted(getattr(mongomock.collection.Collection, name)))
+  original_iter = mongomock.collection.Cursor.__next__
+  def locked_next(self):
+    with lock: return original_iter(self)
+  mongomock.collection.Cursor.__next__ = locked_next
+  database.use(mongomock.MongoClient()[os.environ['MONGO_DATABASE']])
+  return 'mongomock'
+
+def seed(volumes):
+  from chalicelib.util import database, hashing
+  from chalicelib.api import accounts, idps
+  db = database.get_db()
+  token = accounts.create({'email': 'benchmark@example.com', 'password': 'benchmark-password', 'firstName': 'Bench', 'lastName': 'Mark'})['token']
+  user = db.users.find_one({'email': 'benchmark@example.com'})
+  password_hash = user['password']
+  idp_user_hash = hashing.hash_password('password', 'idpUsers')
+  now = datetime.datetime.utcnow()
+  idp_ids = []
+  for i in range(volumes['idps']):
+    idp = idps.create(user, {'name': 'Benchmark IdP {0}'.format(i), 'code': 'benchmark-{0}'.format(i)})
+    idp_ids.append(idp['_id'])
+    seeded_users = [{'firstName': 'User', 'lastName': str(n), 'email': 'user{0}@example.com'.format(n), 'password': idp_user_hash, 'attributes': {}, 'idp': idp['_id']} for n in range(volumes['users'])]
+    for seeded_user in seeded_users: seeded_user['searchKeys'] = idps.search_keys(seeded_user)
+    if seeded_users: db.idpUsers.insert_many(seeded_users)
+    sp_id = db.idpSps.insert_one({'name': 'Benchmark SP', 'entityId': 'https://sp.example.com', 'type': 'saml', 'oauth2ClientId': str(ObjectId()), 'idp': idp['_id']}).inserted_id
+    db.idps.update_one({'_id': idp['_id']}, {'$inc': {'counts.users': len(seeded_users), 'counts.sps': 1}})
+    for collection, types in [(db.requests, ['loginRequest', 'loginResponse', 'logoutRequest']), (db.oauthRequests, ['authorizeRequest', 'tokenRequest', 'tokenResponse'])]:
+      if volumes['logs']: collection.insert_many([{
+        'idp': idp['_id'],
+        'sp': sp_id,
+        'type': types[n % len(types)],
+        'data': {'assertion': {'key': 'key', 'attributes': {'email': 'user@example.com'}}, 'samlStatusCode': 'urn:oasis:names:tc:SAML:2.0:status:Success'},
+        'createdAt': now - datetime.timedelta(seconds=n),
+      } for n in range(volumes['logs'])])
+  return {'token': token, 'user': user, 'passwordHash': password_hash, 'idps': idp_ids}
+
+def prepare(ctx, scenario, count):
+  # Creates the documents consumed one per request by scenarios that delete or rename things
+  from chalicelib.util import database
+  from chalicelib.api import accounts
+  db = database.get_db()
+  idp = ctx['idps'][0]
+  if scenario in ('delete_sp', 'update_sp'):
+    db.idps.update_one({'_id': idp}, {'$inc': {'counts.sps': count}})
+    return [str(db.idpSps.insert_one({'name': 'SP', 'idp': idp}).inserted_id) for _ in range(count)]
+  if scenario in ('delete_idp_user', 'update_idp_user'):
+    db.idps.update_one({'_id': idp}, {'$inc': {'counts.users': count}})
+    return [str(db.idpUsers.insert_one({'email': 'tmp@example.com', 'searchKeys': ['tmp@example.com'], 'idp': idp}).inserted_id) for _ in range(count)]
+  if scenario in ('delete_attribute', 'update_attribute'):
+    db.idps.update_one({'_id': idp}, {'$inc': {'counts.attributes': count}})
+    return [str(db.idpAttributes.insert_one({'name': 'Attribute', 'idp': idp}).inserted_id) for _ in range(count)]
+  if scenario == 'delete_idp':
+    return [str(db.idps.insert_one({'name': 'Temporary', 'code': 'tmp-' + str(ObjectId()), 'user': ctx['user']['_id'], 'version': 1}).inserted_id) for _ in range(count)]
+  if scenario in ('logout', 'delete_account'):
+    users = [db.users.insert_one({'email': 'tmp{0}@example.com'.format(ObjectId()), 'firstName': 'Tmp', 'password': ctx['passwordHash']}).inserted_id for _ in range(count)]
+    return [accounts.generate_access_token(user_id) for user_id in users]
+  return [None] * count
+
+def scenarios(ctx):
+  idp = str(ctx['idps'][0])
+  me = str(ctx['user']['_id'])
+  # The calls a provisioning script makes for a new IdP, sent as one batch
+  provision = [{'id': 'idp', 'method': 'POST', 'path': '/idps', 'body': {'name': 'Batch IdP'}}]
+  provision += [{'method': 'POST', 'path': '/idps/{{idp}}/sps', 'body': {'name': 'SP {0}'.format(n), 'entityId': 'https://sp{0}.example.com'.format(n)}} for n in range(5)]
+  provision += [{'method': 'POST', 'path': '/idps/{{idp}}/attributes', 'body': {'name': 'Attribute {0}'.format(n)}} for n in range(5)]
+  provision += [{'method': 'POST', 'path': '/idps/{{idp}}/users', 'body': {'email': 'batch{0}@example.com'.format(n), 'password': 'password'}} for n in range(10)]
+  csv = 'email,password,firstName\n' + ''.join('import{0}@example.com,password,Import\n'.format(n) for n in range(20))
+  return [
+    # name, method, path, body, uses a prepared document or token
+    ('register', 'POST', lambda i, x: '/accounts', lambda i, x: {'email': 'new{0}-{1}@example.com'.format(i, ObjectId()), 'password': 'benchmark-password', 'firstName': 'New'}),
+    ('login', 'POST', lambda i, x: '/accounts/sessions', lambda i, x: {'email': 'benchmark@example.com', 'password': 'benchmark-password'}),
+    ('enrol', 'POST', lambda i, x: '/accounts/enrol', lambda i, x: {'token': 'invalid', 'password': 'benchmark-password'}),
+    ('reset_password', 'POST', lambda i, x: '/accounts/password/reset', lambda i, x: {'email': 'benchmark@example.com'}),
+    ('users_me', 'GET', lambda i, x: '/users/me', None),
+    ('update_user', 'PUT', lambda i, x: '/users/' + me, lambda i, x: {'firstName': 'Bench'}),
+    ('list_idps', 'GET', lambda i, x: '/idps', None),
+    ('create_idp', 'POST', lambda i, x: '/idps', lambda i, x: {'name': 'New IdP', 'code': 'new-' + str(ObjectId())}),
+    ('get_idp', 'GET', lambda i, x: '/idps/' + idp, None),
+    ('update_idp', 'PUT', lambda i, x: '/idps/' + idp, lambda i, x: {'name': 'Benchmark IdP'}),
+    ('snapshot', 'GET', lambda i, x: '/idps/{0}/snapshot'.format(idp), None),
+    ('get_sps', 'GET', lambda i, x: '/idps/{0}/sps'.format(idp), None),
+    ('create_sp', 'POST', lambda i, x: '/idps/{0}/sps'.format(idp), lambda i, x: {'name': 'SP', 'entityId': 'https://sp.example.com'}),
+    ('update_sp', 'PUT', lambda i, x: '/idps/{0}/sps/{1}'.format(idp, x), lambda i, x: {'name': 'Renamed'}),
+    ('delete_sp', 'DELETE', lambda i, x: '/idps/{0}/sps/{1}'.format(idp, x), None),
+    ('get_idp_users', 'GET', lambda i, x: '/idps/{0}/users'.format(idp), None),
+    ('search_idp_users', 'GET', lambda i, x: '/idps/{0}/users?q=user1&fields=email'.format(idp), None),
+    ('create_idp_user', 'POST', lambda i, x: '/idps/{0}/users'.format(idp), lambda i, x: {'email': 'created@example.com', 'password': 'password'}),
+    ('import_idp_users', 'POST', lambda i, x: '/idps/{0}/users/import'.format(idp), lambda i, x: csv),
+    ('update_idp_user', 'PUT', lambda i, x: '/idps/{0}/users/{1}'.format(idp, x), lambda i, x: {'firstName': 'Renamed'}),
+    ('delete_idp_user', 'DELETE', lambda i, x: '/idps/{0}/users/{1}'.format(idp, x), None),
+    ('get_attributes', 'GET', lambda i, x: '/idps/{0}/attributes'.format(idp), None),
+    ('create_attribute', 'POST', lambda i, x: '/idps/{0}/attributes'.format(idp), lambda i, x: {'name': 'Attribute'}),
+    ('update_attribute', 'PUT', lambda i, x: '/idps/{0}/attributes/{1}'.format(idp, x), lambda i, x: {'name': 'Renamed'}),
+    ('delete_attribute', 'DELETE', lambda i, x: '/idps/{0}/attributes/{1}'.format(idp, x), None),
+    ('saml_logs', 'GET', lambda i, x: '/idps/{0}/saml2/logs'.format(idp), None),
+    ('saml_logs_filtered', 'GET', lambda i, x: '/idps/{0}/saml2/logs?type=loginResponse&limit=100'.format(idp), None),
+    ('oauth_logs', 'GET', lambda i, x: '/idps/{0}/oauth2/logs'.format(idp), None),
+    ('export_logs', 'GET', lambda i, x: '/idps/{0}/saml2/logs/export?limit=1000'.format(idp), None),
+    ('stats', 'GET', lambda i, x: '/idps/{0}/stats'.format(idp), None),
+    ('batch_provision_idp', 'POST', lambda i, x: '/batch', lambda i, x: {'operations': [dict(provision[0], body={'name': 'Batch IdP', 'code': 'batch-' + str(ObjectId())})] + provision[1:]}),
+    ('delete_idp', 'DELETE', lambda i, x: '/idps/' + x, None),
+    ('logout', 'DELETE', lambda i, x: '/accounts/sessions', None),
+    ('delete_account', 'DELETE', lambda i, x: '/accounts', lambda i, x: {'password': 'benchmark-password'}),
+  ]
+
+def percentile(values, fraction):
+  if not values: return None
+  return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_scenario(app, ctx, counter, scenario, requests, concurrency):
+  name, method, path, body = scenario
+  prepared = prepare(ctx, name, requests)
+  clients = threading.local()
+
+  def call(i):
+    if not hasattr(clients, 'client'): clients.client = app.test_client()
+    token = prepared[i] if name in ('logout', 'delete_account') else ctx['token']
+    headers = {'Authorization': 'Bearer ' + token}
+    data = body(i, prepared[i]) if body else None
+    kwargs = {'json': data} if isinstance(data, dict) else {'data': io.BytesIO(data.encode('utf-8')), 'content_type': 'text/csv'} if data else {}
+    start = time.perf_counter()
+    response = clients.client.open(path(i, prepared[i]), method=method, headers=headers, **kwargs)
+    response.get_data()
+    return time.perf_counter() - start, response.status_code
+
+  operations = counter.count
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    results = list(executor.map(call, range(requests)))
+  elapsed = time.perf_counter() - start
+  operations = counter.count - operations
+
+  latencies = sorted(latency * 1000 for latency, _ in results)
+  statuses = {}
+  for _, status in results: statuses[str(status)] = statuses.get(str(status), 0) + 1
+  return {
+    'requests': requests,
+    'statusCodes': statuses,
+    'errors': sum(count for status, count in statuses.items() if int(status) >= 400),
+    'throughput': requests / elapsed,
+    'meanMs': sum(latencies) / len(latencies),
+    'p50Ms': percentile(latencies, 0.50),
+    'p95Ms': percentile(latencies, 0.95),
+    'p99Ms': percentile(latencies, 0.99),
+    'mongoOpsPerRequest': operations / requests,
+  }
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(args):
+  warnings.simplefilter('ignore', DeprecationWarning)
+  counter = OperationCounter()
+  backend = connect(args.mongo_url, counter)
+  import app as app_module
+  # Limits are per minute and would turn most of the run into 429s
+  app_module.limiter.enabled = args.rate_limits
+  volumes = {'idps': args.idps, 'users': args.users, 'logs': args.logs}
+  ctx = seed(volumes)
+  selected = args.scenarios.split(',') if args.scenarios else None
+
+  results = {}
+  print('{0:<20} {1:>8} {2:>9} {3:>9} {4:>9} {5:>10} {6:>8} {7:>7}'.format('scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'mongo ops', 'errors', 'codes'))
+  for scenario in scenarios(ctx):
+    if selected and scenario[0] not in selected: continue
+    requests = max(1, args.requests // 10) if scenario[0] in ('register', 'login', 'delete_account', 'create_idp', 'import_idp_users') else args.requests
+    result = run_scenario(app_module.app, ctx, counter, scenario, requests, args.concurrency)
+    results[scenario[0]] = result
+    print('{0:<20} {1:>8.1f} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>10.1f} {6:>8} {7}'.format(scenario[0], result['throughput'], result['p50Ms'], result['p95Ms'], result['p99Ms'], result['mongoOpsPerRequest'], result['errors'], ','.join(sorted(result['statusCodes']))))
+
+  commit = git_commit()
+  report = {
+    'commit': commit,
+    'createdAt': datetime.datetime.utcnow().isoformat(),
+    'backend': backend,
+    'concurrency': args.concurrency,
+    'volumes': volumes,
+    'rateLimits': args.rate_limits,
+    'results': results,
+  }
+  output = args.output or os.path.join('benchmarks', 'results', 'endpoints-{0}-{1}.json'.format(commit or 'unknown', datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+  os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+  with open(output, 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
+  print('Results written to ' + output)
+
+def compare(old_path, new_path):
+  with open(old_path) as f: old = json.load(f)
+  with open(new_path) as f: new = json.load(f)
+  print('{0} -> {1}'.format(old.get('commit'), new.get('commit')))
+  print('{0:<20} {1:>16} {2:>16} {3:>16}'.format('scenario', 'p50 ms', 'p99 ms', 'mongo ops'))
+  for name, result in new['results'].items():
+    before = old['results'].get(name)
+    if not before: continue
+    cells = ['{0:.2f} -> {1:.2f}'.format(before[key], result[key]) for key in ('p50Ms', 'p99Ms', 'mongoOpsPerRequest')]
+    print('{0:<20} {1:>16} {2:>16} {3:>16}'.format(name, *cells))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mongo-url', help='Use a local mongod instead of mongomock. The benchmark database is dropped first.')
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--requests', type=int, default=200, help='Requests per scenario. Scenarios that hash passwords or generate keys run a tenth of this.')
+  parser.add_argument('--idps', type=int, default=3)
+  parser.add_argument('--users', type=int, default=500, help='Users seeded per IdP')
+  parser.add_argument('--logs', type=int, default=2000, help='SAML and OAuth logs seeded per IdP')
+  parser.add_argument('--scenarios', help='Comma separated scenario names to run')
+  parser.add_argument('--rate-limits', action='store_true', help='Keep the rate limiter enabled')
+  parser.add_argument('--output')
+  parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+  args = parser.parse_args()
+  if args.compare: compare(*args.compare)
+  else: run(args)
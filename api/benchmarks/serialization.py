@@ -0,0 +1,60 @@
+# Compares the response encoders on payloads shaped like get_logs and get_users.
+# Run from the api directory with: python -m benchmarks.serialization
+import datetime, timeit, argparse
+from bson.objectid import ObjectId
+from chalicelib.util import serialization
+
+def logs_payload(count):
+  idp, sp = ObjectId(), ObjectId()
+  logs = []
+  for i in range(count):
+    logs.append({
+      '_id': ObjectId(),
+      'createdAt': datetime.datetime.utcnow(),
+      'idp': idp,
+      'sp': sp,
+      'spName': 'Example SP',
+      'type': 'loginResponse',
+      'data': {
+        'instant': datetime.datetime.utcnow().isoformat(),
+        'issuer': 'https://idp.sso.tools/example',
+        'inResponseTo': '_' + str(ObjectId()),
+        'destination': 'https://sp.example.com/saml/acs',
+        'assertion': {
+          'key': 'REDACTED',
+          'cert': '-----BEGIN CERTIFICATE-----\n' + 'A' * 800 + '\n-----END CERTIFICATE-----\n',
+          'issuer': 'https://idp.sso.tools/example',
+          'nameIdentifier': 'user{0}@example.com'.format(i),
+          'attributes': {'firstName': 'Joe', 'lastName': 'Bloggs', 'email': 'user{0}@example.com'.format(i), 'group': 'staff'},
+        },
+        'samlStatusCode': 'urn:oasis:names:tc:SAML:2.0:status:Success',
+      }
+    })
+  return {'logs': logs}
+
+def users_payload(count):
+  idp = ObjectId()
+  return {'users': [{
+    '_id': ObjectId(),
+    'firstName': 'User',
+    'lastName': str(i),
+    'email': 'user{0}@example.com'.format(i),
+    'attributes': {str(ObjectId()): 'staff'},
+    'idp': idp,
+  } for i in range(count)]}
+
+def run(payloads, repeat):
+  print('{0:<12} {1:<8} {2:>12} {3:>12}'.format('payload', 'backend', 'dumps (ms)', 'stream (ms)'))
+  for name, payload in payloads.items():
+    for backend in serialization.backends:
+      dumps = min(timeit.repeat(lambda: serialization.dumps(payload, backend), number=1, repeat=repeat)) * 1000
+      stream = min(timeit.repeat(lambda: ''.join(serialization.iter_dumps(payload, backend)), number=1, repeat=repeat)) * 1000
+      print('{0:<12} {1:<8} {2:>12.2f} {3:>12.2f}'.format(name, backend, dumps, stream))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--logs', type=int, default=100)
+  parser.add_argument('--users', type=int, default=5000)
+  parser.add_argument('--repeat', type=int, default=20)
+  args = parser.parse_args()
+  run({'get_logs': logs_payload(args.logs), 'get_users': users_payload(args.users)}, args.repeat)
@@ -0,0 +1,88 @@
+# Measures worker cold starts: how long importing app.py takes in a fresh interpreter, and how long a freshly started gunicorn takes to answer its first request.
+# Run from the api directory with: python -m benchmarks.startup [--mongo-url mongodb://localhost:27017]
+# Import times need no database. The server measurements need --mongo-url and gunicorn, and compare preloaded and non-preloaded workers using gunicorn.conf.py.
+import os, sys, json, time, datetime, argparse, subprocess
+from benchmarks import endpoints
+
+# Heavy modules that only some requests need, reported so regressions in lazy loading show up
+watched_modules = ['OpenSSL', 'requests', 'bcrypt', 'jwt', 'pymongo', 'flask_limiter']
+import_probe = '''
+import sys, time, json
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': len(sys.modules), 'loaded': [name for name in %r if name in sys.modules]}))
+''' % (watched_modules,)
+
+def measure_imports(runs, env):
+  samples = []
+  for _ in range(runs):
+    output = subprocess.check_output([sys.executable, '-c', import_probe], env=env, stderr=subprocess.DEVNULL)
+    samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+  seconds = sorted(sample['seconds'] * 1000 for sample in samples)
+  return {'runs': runs, 'p50Ms': endpoints.percentile(seconds, 0.50), 'maxMs': seconds[-1], 'modules': samples[-1]['modules'], 'loaded': samples[-1]['loaded']}
+
+def measure_server(preload, port, token, requests, env):
+  import httpx
+  env = dict(env, GUNICORN_PRELOAD='true' if preload else 'false', GUNICORN_BIND='127.0.0.1:{0}'.format(port))
+  url = 'http://127.0.0.1:{0}/users/me'.format(port)
+  headers = {'Authorization': 'Bearer ' + token}
+  start = time.perf_counter()
+  process = subprocess.Popen(['gunicorn', '--workers', '1', 'app:app'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    # The first request is retried until the worker accepts it, so it covers boot, warm-up and the request itself
+    while True:
+      if process.poll() is not None: raise RuntimeError('gunicorn exited during startup')
+      if time.perf_counter() - start > 60: raise RuntimeError('gunicorn did not answer within 60 seconds')
+      try:
+        request_start = time.perf_counter()
+        response = httpx.get(url, headers=headers, timeout=30)
+        break
+      except httpx.TransportError:
+        time.sleep(0.02)
+    first_response = time.perf_counter() - start
+    first_latency = time.perf_counter() - request_start
+    latencies = []
+    with httpx.Client(headers=headers, timeout=30) as client:
+      for _ in range(requests):
+        request_start = time.perf_counter()
+        client.get(url)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+    latencies.sort()
+    return {'status': response.status_code, 'firstResponseMs': first_response * 1000, 'firstRequestMs': first_latency * 1000, 'warmP50Ms': endpoints.percentile(latencies, 0.50)}
+  finally:
+    process.terminate()
+    process.wait()
+
+def run(args):
+  env = dict(os.environ, RATELIMIT_ENABLED='false')
+  results = {'imports': measure_imports(args.runs, env)}
+  imports = results['imports']
+  print('import app: p50 {0:.1f} ms, max {1:.1f} ms, {2} modules, loaded: {3}'.format(imports['p50Ms'], imports['maxMs'], imports['modules'], ', '.join(imports['loaded'])))
+
+  if args.mongo_url:
+    endpoints.connect(args.mongo_url, endpoints.OperationCounter())
+    ctx = endpoints.seed({'idps': 1, 'users': 10, 'logs': 0})
+    env['MONGO_URL'] = args.mongo_url
+    results['servers'] = {}
+    for port, preload in enumerate([True, False], start=args.port):
+      mode = 'preload' if preload else 'no-preload'
+      result = results['servers'][mode] = measure_server(preload, port, ctx['token'], args.requests, env)
+      print('{0:<11} first response after {1:.0f} ms, first request {2:.1f} ms, warm p50 {3:.1f} ms (status {4})'.format(mode, result['firstResponseMs'], result['firstRequestMs'], result['warmP50Ms'], result['status']))
+
+  commit = endpoints.git_commit()
+  report = dict(results, commit=commit, createdAt=datetime.datetime.utcnow().isoformat())
+  output = args.output or os.path.join('benchmarks', 'results', 'startup-{0}-{1}.json'.format(commit or 'unknown', datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+  os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+  with open(output, 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
+  print('Results written to ' + output)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mongo-url', help='Also time gunicorn cold starts against this server. The benchmark database on it is dropped and reseeded.')
+  parser.add_argument('--runs', type=int, default=10, help='Fresh interpreters used to time the import')
+  parser.add_argument('--requests', type=int, default=20, help='Requests sent after the first one to measure warm latency')
+  parser.add_argument('--port', type=int, default=6200)
+  parser.add_argument('--output')
+  args = parser.parse_args()
+  run(args)
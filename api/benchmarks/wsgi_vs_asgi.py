@@ -0,0 +1,109 @@
+# Compares the Flask app under sync gunicorn workers with the ASGI app under uvicorn workers, at the same worker count and client concurrency.
+# Both servers run against the same seeded mongod, so Mongo round trips are real. Requires gunicorn, uvicorn, motor, asgiref and httpx.
+# Run from the api directory with: python -m benchmarks.wsgi_vs_asgi --mongo-url mongodb://localhost:27017
+import os, json, time, asyncio, datetime, argparse, subprocess
+import httpx
+from benchmarks import endpoints
+
+servers = {
+  'wsgi': ['gunicorn', '--workers', '{workers}', '--bind', '127.0.0.1:{port}', 'app:app'],
+  'asgi': ['gunicorn', '--workers', '{workers}', '--worker-class', 'uvicorn.workers.UvicornWorker', '--bind', '127.0.0.1:{port}', 'asgi:app'],
+}
+routes = {
+  'users_me': '/users/me',
+  'list_idps': '/idps',
+  'get_idp': '/idps/{idp}',
+  'snapshot': '/idps/{idp}/snapshot',
+  'get_idp_users': '/idps/{idp}/users',
+  'saml_logs': '/idps/{idp}/saml2/logs',
+  'oauth_logs': '/idps/{idp}/oauth2/logs',
+  'stats': '/idps/{idp}/stats',
+}
+
+def start_server(mode, workers, port, env):
+  command = [part.format(workers=workers, port=port) for part in servers[mode]]
+  process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  deadline = time.monotonic() + 30
+  while time.monotonic() < deadline:
+    if process.poll() is not None: raise RuntimeError('{0} server exited during startup: {1}'.format(mode, ' '.join(command)))
+    try:
+      httpx.get('http://127.0.0.1:{0}/metrics'.format(port), timeout=1)
+      return process
+    except httpx.TransportError:
+      time.sleep(0.2)
+  process.terminate()
+  raise RuntimeError('{0} server did not start within 30 seconds'.format(mode))
+
+async def drive(base_url, path, token, requests, concurrency):
+  semaphore = asyncio.Semaphore(concurrency)
+  latencies = []
+  statuses = {}
+  limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+  async with httpx.AsyncClient(base_url=base_url, headers={'Authorization': 'Bearer ' + token}, limits=limits, timeout=60) as client:
+    async def call():
+      async with semaphore:
+        start = time.perf_counter()
+        response = await client.get(path)
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+    await call()
+    latencies.clear()
+    statuses.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*[call() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+  latencies.sort()
+  return {
+    'requests': requests,
+    'statusCodes': statuses,
+    'throughput': requests / elapsed,
+    'p50Ms': endpoints.percentile(latencies, 0.50),
+    'p95Ms': endpoints.percentile(latencies, 0.95),
+    'p99Ms': endpoints.percentile(latencies, 0.99),
+  }
+
+def run(args):
+  counter = endpoints.OperationCounter()
+  endpoints.connect(args.mongo_url, counter)
+  volumes = {'idps': args.idps, 'users': args.users, 'logs': args.logs}
+  ctx = endpoints.seed(volumes)
+  env = dict(os.environ, MONGO_URL=args.mongo_url, RATELIMIT_ENABLED='false', MAIL_BACKGROUND_DELIVERY='false')
+  selected = args.routes.split(',') if args.routes else list(routes)
+
+  results = {}
+  for port, mode in enumerate(servers, start=args.port):
+    process = start_server(mode, args.workers, port, env)
+    try:
+      for name in selected:
+        path = routes[name].format(idp=ctx['idps'][0])
+        results.setdefault(name, {})[mode] = asyncio.run(drive('http://127.0.0.1:{0}'.format(port), path, ctx['token'], args.requests, args.concurrency))
+    finally:
+      process.terminate()
+      process.wait()
+
+  print('{0:<16} {1:>20} {2:>20} {3:>20}'.format('route', 'req/s wsgi/asgi', 'p50 ms wsgi/asgi', 'p99 ms wsgi/asgi'))
+  for name, modes in results.items():
+    cells = ['{0:.1f} / {1:.1f}'.format(modes['wsgi'][key], modes['asgi'][key]) for key in ('throughput', 'p50Ms', 'p99Ms')]
+    print('{0:<16} {1:>20} {2:>20} {3:>20}'.format(name, *cells))
+
+  commit = endpoints.git_commit()
+  report = {'commit': commit, 'createdAt': datetime.datetime.utcnow().isoformat(), 'workers': args.workers, 'concurrency': args.concurrency, 'volumes': volumes, 'results': results}
+  output = args.output or os.path.join('benchmarks', 'results', 'wsgi-vs-asgi-{0}-{1}.json'.format(commit or 'unknown', datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+  os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+  with open(output, 'w') as f: json.dump(report, f, indent=2, sort_keys=True)
+  print('Results written to ' + output)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mongo-url', required=True, help='The benchmark database on this server is dropped and reseeded')
+  parser.add_argument('--workers', type=int, default=2)
+  parser.add_argument('--concurrency', type=int, default=32)
+  parser.add_argument('--requests', type=int, default=1000, help='Requests per route and server')
+  parser.add_argument('--idps', type=int, default=3)
+  parser.add_argument('--users', type=int, default=500)
+  parser.add_argument('--logs', type=int, default=2000)
+  parser.add_argument('--routes', help='Comma separated route names: ' + ','.join(routes))
+  parser.add_argument('--port', type=int, default=6100)
+  parser.add_argument('--output')
+  args = parser.parse_args()
+  run(args)
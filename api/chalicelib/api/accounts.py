@@ -1,8 +1,11 @@
-import datetime, jwt, bcrypt, os
+import datetime, time, jwt, os
 from bson.objectid import ObjectId
-from chalicelib.util import database, mail, errors
+from chalicelib.util import database, mail, errors, cache, last_seen, sessions, hashing, cascade, owners, metrics
 
 jwt_secret = os.environ.get('JWT_SECRET')
+user_cache = cache.TTLCache(int(os.environ.get('USER_CACHE_SIZE', 1024)), int(os.environ.get('USER_CACHE_TTL', 60)))
+user_cache_warm_window = int(os.environ.get('USER_CACHE_WARM_WINDOW', 900))
+metrics.collect_cache('users', user_cache)
 
 def create(data):
   email = data.get('email')
@@ -18,7 +21,7 @@ def create(data):
   existingUser = db.users.find_one({'email': email})
   if existingUser: raise errors.BadRequest('An account with this email already exists.')
 
-  hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+  hashed_password = hashing.hash_password(password, 'users')
   new_user = {
     'firstName': first_name,
     'lastName': last_name,
@@ -29,7 +32,7 @@ def create(data):
   result = db.users.insert_one(new_user)
   new_user['_id'] = result.inserted_id
   if len(idps_to_claim):
-    db.idps.update({'_id': {'$in': idps_to_claim}, 'user': {'$exists': False}}, {'$set': {'user': new_user['_id']}}, multi=True)
+    db.idps.update({'_id': {'$in': idps_to_claim}, 'user': {'$exists': False}}, {'$set': {'user': new_user['_id']}, '$inc': {'version': 1}}, multi=True)
   return {'token': generate_access_token(new_user['_id'])}
 
 def enrol(data):
@@ -42,9 +45,11 @@ def enrol(data):
     db = database.get_db()
     id = jwt.decode(data['token'], jwt_secret)['sub']
     user = db.users.find_one({'_id': ObjectId(id), 'tokens.enrolment': token})
-    hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    hashed_password = hashing.hash_password(password, 'users')
     db.users.update({'_id': user['_id']}, {'$set': {'password': hashed_password}, '$unset': {'tokens.enrolment': ''}})
     return {'token': generate_access_token(user['_id'])}
+  except errors.ServiceUnavailable:
+    raise
   except Exception as e:
     print(e)
     raise errors.BadRequest('Unable to enrol your account. Your token may be invalid or expired.')
@@ -58,19 +63,23 @@ def login(data):
   db = database.get_db()
   user = db.users.find_one({'email': email.lower()})
   try:
-    if user and bcrypt.checkpw(password.encode("utf-8"), user['password']):
+    if user and hashing.checkpw(password.encode("utf-8"), user['password']):
+      if hashing.needs_rehash(user['password'], 'users'):
+        db.users.update_one({'_id': user['_id']}, {'$set': {'password': hashing.hash_password(password, 'users')}})
       if len(idps_to_claim):
-        db.idps.update({'_id': {'$in': idps_to_claim}, 'user': {'$exists': False}}, {'$set': {'user': user['_id']}}, multi=True)
+        db.idps.update({'_id': {'$in': idps_to_claim}, 'user': {'$exists': False}}, {'$set': {'user': user['_id']}, '$inc': {'version': 1}}, multi=True)
       return {'token': generate_access_token(user['_id'])}
     else:
       raise errors.BadRequest('Your email or password is incorrect.')
+  except errors.ServiceUnavailable:
+    raise
   except Exception as e:
     print(e)
     raise errors.BadRequest('Your email or password is incorrect.')
 
 def logout(user):
-  db = database.get_db()
-  db.users.update({'_id': user['_id']}, {'$pull': {'tokens.login': user['currentToken']}})
+  sessions.revoke(user['currentToken'])
+  user_cache.invalidate(sessions.hash_token(user['currentToken']))
   return {'loggedOut': True}
 
 def update_password(user, data):
@@ -80,7 +89,7 @@ def update_password(user, data):
 
   db = database.get_db()
   if 'currentPassword' in data:
-    if not bcrypt.checkpw(data['currentPassword'].encode('utf-8'), user['password']):
+    if not hashing.checkpw(data['currentPassword'].encode('utf-8'), user['password']):
       raise errors.BadRequest('Incorrect password')
   elif 'token' in data:
     try:
@@ -94,48 +103,85 @@ def update_password(user, data):
     raise errors.BadRequest('Current password or reset token is required')
   if not user: raise errors.BadRequest('Unable to change your password')
 
-  hashed_password = bcrypt.hashpw(data['newPassword'].encode("utf-8"), bcrypt.gensalt())
+  hashed_password = hashing.hash_password(data['newPassword'], 'users')
   db.users.update({'_id': user['_id']}, {'$set': {'password': hashed_password}, '$unset': {'tokens.passwordReset': ''}})
+  invalidate_user(user['_id'])
   return {'passwordUpdated': True}
 
 def delete(user, password):
-  if not password or not bcrypt.checkpw(password.encode('utf-8'), user['password']):
+  if not password or not hashing.checkpw(password.encode('utf-8'), user['password']):
     raise errors.BadRequest('Incorrect password')
   db = database.get_db()
-  for idp in db.idps.find({'user': user['_id']}):
-    db.idpSps.remove({'idp': idp['_id']})
-    db.idpUsers.remove({'idp': idp['_id']})
-    db.idpAttributes.remove({'idp': idp['_id']})
-  db.idps.remove({'user': user['_id']})
+  idp_ids = [idp['_id'] for idp in db.idps.find({'user': user['_id']}, {'_id': 1})]
+  db.idps.delete_many({'_id': {'$in': idp_ids}})
+  owners.invalidate_user(user['_id'])
   db.users.remove({'_id': user['_id']})
+  cascade.enqueue(idp_ids)
+  sessions.revoke_user(user['_id'])
+  invalidate_user(user['_id'])
   return {'deletedUser': user['_id']}
 
 def generate_access_token(user_id):
+  token, expires_at = encode_access_token(user_id)
+  sessions.create(user_id, token, expires_at)
+  return token
+
+def encode_access_token(user_id):
   payload = {
     'exp': datetime.datetime.utcnow() + datetime.timedelta(days=30),
     'iat': datetime.datetime.utcnow(),
     'sub': str(user_id)
   }
-  token = jwt.encode(payload, jwt_secret, algorithm='HS256')
-  db = database.get_db()
-  db.users.update({'_id': user_id}, {'$addToSet': {'tokens.login': token}})
-  return token
+  return jwt.encode(payload, jwt_secret, algorithm='HS256'), payload['exp']
+
+def invalidate_user(user_id):
+  user_cache.invalidate_group(str(user_id))
 
-def get_user_context(token):
+def get_token_subject(token):
+  try:
+    return jwt.decode(token, jwt_secret, algorithms=['HS256']).get('sub')
+  except jwt.InvalidTokenError:
+    return None
+
+def get_user_context(token, fresh=False):
+  # Logouts only invalidate the cache of the worker that handled them, so writes (fresh) always check the session again
   if not token: return None
+  key = sessions.hash_token(token)
+  user = None if fresh else user_cache.get(key)
+  if user:
+    last_seen.touch(user['_id'], user.get('lastSeenAt'))
+    return dict(user, currentToken=token)
   try:
     payload = jwt.decode(token, jwt_secret, algorithms=['HS256'])
     id = payload['sub']
     if id:
+      if not sessions.find(ObjectId(id), token): return None
       db = database.get_db()
-      user = db.users.find_one({'_id': ObjectId(id), 'tokens.login': token})
-      db.users.update({'_id': user['_id']}, {'$set': {'lastSeenAt': datetime.datetime.now()}})
-      user['currentToken'] = token
-      return user
+      user = db.users.find_one({'_id': ObjectId(id)}, {'tokens.login': 0})
+      if not user: return None
+      last_seen.touch(user['_id'], user.get('lastSeenAt'))
+      expires_in = payload['exp'] - time.time() if 'exp' in payload else None
+      user_cache.set(key, user, str(user['_id']), expires_in)
+      return dict(user, currentToken=token)
   except Exception as e:
     print(e)
     return None
 
+def warm_user_cache():
+  # Caches the sessions of recently active users, so a new worker's first requests from them skip the session and user reads
+  if not user_cache_warm_window or user_cache.max_size <= 0: return 0
+  db = database.get_db()
+  since = datetime.datetime.now() - datetime.timedelta(seconds=user_cache_warm_window)
+  active = {user['_id']: user for user in db.users.find({'lastSeenAt': {'$gte': since}}, {'tokens.login': 0}).sort('lastSeenAt', -1).limit(user_cache.max_size)}
+  if not active: return 0
+  now = datetime.datetime.utcnow()
+  warmed = 0
+  for session in db.sessions.find({'user': {'$in': list(active)}, 'expiresAt': {'$gt': now}}).sort('createdAt', -1).limit(user_cache.max_size):
+    user = active[session['user']]
+    user_cache.set(session['_id'], user, str(user['_id']), (session['expiresAt'] - now).total_seconds())
+    warmed += 1
+  return warmed
+
 def reset_password(data):
   if not data or not 'email' in data: raise errors.BadRequest('Invalid request')
   if len(data['email']) < 5: raise errors.BadRequest('Your email is too short')
@@ -0,0 +1,59 @@
+import asyncio, time, jwt
+from bson.objectid import ObjectId
+from chalicelib.util import async_database, errors, last_seen, sessions, hashing
+from chalicelib.api import accounts
+
+async def login(data):
+  email = data.get('email')
+  password = data.get('password')
+  idps_to_claim = data.get('idpsToClaim', []) or []
+  idps_to_claim = list(map(lambda i: ObjectId(i), idps_to_claim))
+
+  db = async_database.get_db()
+  user = await db.users.find_one({'email': email.lower()})
+  try:
+    if user and await asyncio.to_thread(hashing.checkpw, password.encode("utf-8"), user['password']):
+      if hashing.needs_rehash(user['password'], 'users'):
+        hashed_password = await asyncio.to_thread(hashing.hash_password, password, 'users')
+        await db.users.update_one({'_id': user['_id']}, {'$set': {'password': hashed_password}})
+      if len(idps_to_claim):
+        await db.idps.update_many({'_id': {'$in': idps_to_claim}, 'user': {'$exists': False}}, {'$set': {'user': user['_id']}, '$inc': {'version': 1}})
+      return {'token': await generate_access_token(user['_id'])}
+    else:
+      raise errors.BadRequest('Your email or password is incorrect.')
+  except errors.ServiceUnavailable:
+    raise
+  except Exception as e:
+    print(e)
+    raise errors.BadRequest('Your email or password is incorrect.')
+
+async def generate_access_token(user_id):
+  token, expires_at = accounts.encode_access_token(user_id)
+  await async_database.get_db().sessions.update_one(*sessions.upsert(user_id, token, expires_at), upsert=True)
+  return token
+
+async def get_user_context(token, fresh=False):
+  if not token: return None
+  key = sessions.hash_token(token)
+  user = None if fresh else accounts.user_cache.get(key)
+  if user:
+    last_seen.touch(user['_id'], user.get('lastSeenAt'))
+    return dict(user, currentToken=token)
+  try:
+    payload = jwt.decode(token, accounts.jwt_secret, algorithms=['HS256'])
+    id = payload['sub']
+    if id:
+      db = async_database.get_db()
+      # The session and the user are independent reads, so they run concurrently
+      session, user = await asyncio.gather(
+        db.sessions.find_one({'_id': key, 'user': ObjectId(id)}),
+        db.users.find_one({'_id': ObjectId(id)}, {'tokens.login': 0})
+      )
+      if not session or not user: return None
+      last_seen.touch(user['_id'], user.get('lastSeenAt'))
+      expires_in = payload['exp'] - time.time() if 'exp' in payload else None
+      accounts.user_cache.set(key, user, str(user['_id']), expires_in)
+      return dict(user, currentToken=token)
+  except Exception as e:
+    print(e)
+    return None
@@ -0,0 +1,140 @@
+import asyncio, re
+import pymongo
+from bson.objectid import ObjectId
+from chalicelib.util import async_database, errors, hashing, util, stats, owners
+from chalicelib.api import idps
+
+async def authorize_idp(user, id, message):
+  owner = owners.idp_owners.get(str(id))
+  if owner is None: owner = owners.remember(id, await async_database.get_db().idps.find_one({'_id': id}, {'user': 1}))
+  if owner is owners.missing: raise errors.NotFound('The IdP could not be found')
+  if owner and (not user or owner != user['_id']): raise errors.Forbidden(message)
+
+async def get_version(user, id):
+  idp = await async_database.get_db().idps.find_one({'_id': ObjectId(id)}, {'user': 1, 'version': 1})
+  if not idp: raise errors.NotFound('The IdP could not be found')
+  if not idps.can_manage_idp(user, idp): raise errors.Forbidden('You can\'t view this IdP')
+  return idp.get('version', 0)
+
+async def get_etag(user, id, resource, params=None):
+  return util.etag(str(id), resource, params or {}, await get_version(user, id))
+
+async def get_logs_etag(user, id, kinds, params=None):
+  db = async_database.get_read_db()
+  sort = [('createdAt', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+  newest = await asyncio.gather(*[(db.requests if kind == 'saml2' else db.oauthRequests).find_one({'idp': ObjectId(id)}, {'createdAt': 1}, sort=sort) for kind in kinds])
+  tag = await get_etag(user, id, 'logs:' + ','.join(kinds), params)
+  return util.etag(tag, [util.encode_cursor(log) if log else None for log in newest])
+
+async def create(user, data):
+  db = async_database.get_db()
+  if not data or not data.get('code') or not data.get('name'): raise errors.BadRequest('Name and issuer are required')
+  code = data.get('code').lower().strip()
+
+  if not len(code) or code in idps.forbidden_codes or await db.idps.find_one({'code': code}):
+    raise errors.BadRequest('The issuer is invalid or is already in use')
+  if not re.match(r'^([a-zA-Z0-9\-_]+)$', code): raise errors.BadRequest('The IdP issuer is invalid. Please just use letters, numbers, hyphens, and underscores.')
+
+  # Key generation and the seed users' password hash are CPU-bound, so they run off the event loop at the same time
+  x509, hashed_password = await asyncio.gather(
+    asyncio.to_thread(idps.create_self_signed_cert, data['name']),
+    asyncio.to_thread(hashing.hash_password, idps.seed_password, 'idpUsers', True)
+  )
+  idp = idps.new_idp(user, data, code, x509)
+  result = await db.idps.insert_one(idp)
+  idp['_id'] = result.inserted_id
+
+  new_users, new_attributes = idps.seed_children(idp['_id'], hashed_password)
+  await asyncio.gather(db.idpUsers.insert_many(new_users), db.idpAttributes.insert_many(new_attributes))
+  return idp
+
+async def get(user, include):
+  db = async_database.get_db()
+  if include: include = list(map(lambda i: ObjectId(i), include.split(',')))
+  else: include = []
+
+  if user: query = {'$or': [{'user': user['_id']}, {'_id': {'$in': include}, 'user': {'$exists': False}}]}
+  else: query = {'_id': {'$in': include}, 'user': {'$exists': False}}
+  return {'idps': await db.idps.find(query, {'name': 1, 'code': 1, 'version': 1}).to_list(None)}
+
+async def get_one(user, id):
+  idp = await async_database.get_db().idps.find_one(ObjectId(id))
+  if not idp: raise errors.NotFound('The IdP could not be found')
+  if not idps.can_manage_idp(user, idp): raise errors.Forbidden('You can\'t view this IdP')
+  return idp
+
+async def list_children(user, id, collection, params, message):
+  id = ObjectId(id)
+  await authorize_idp(user, id, message)
+  return await read_children(collection, id, params)
+
+async def read_children(collection, id, params, counts=None):
+  db = async_database.get_db()
+  query, sort, limit, projection, count_query = idps.child_query(collection, id, params)
+  children, total = await asyncio.gather(db[collection].find(query, projection).sort(sort).limit(limit + 1).to_list(None), count_children(collection, id, count_query, counts))
+  return idps.child_page(collection, children, limit, sort, total, count_query is not None)
+
+async def count_children(collection, id, count_query, counts=None):
+  db = async_database.get_db()
+  if count_query is not None: return await db[collection].count_documents(count_query, limit=idps.search_count_limit)
+  if counts is None: counts = (await db.idps.find_one({'_id': id}, {'counts': 1}) or {}).get('counts', {})
+  total = counts.get(idps.child_lists[collection]['section'])
+  return total if total is not None else await db[collection].count_documents({'idp': id})
+
+async def get_sps(user, id, params=None):
+  return await list_children(user, id, 'idpSps', params, 'You can\'t update this IdP')
+
+async def get_users(user, id, params=None):
+  return await list_children(user, id, 'idpUsers', params, 'You can\'t manage this IdP')
+
+async def get_attributes(user, id, params=None):
+  return await list_children(user, id, 'idpAttributes', params, 'You can\'t manage this IdP')
+
+async def get_logs(user, id, params=None):
+  id = ObjectId(id)
+  await authorize_idp(user, id, 'You can\'t access this IdP')
+  result = await query_logs(async_database.get_read_db().requests, id, params or {}, {'data.assertion.key': 0})
+  for log in result['logs']: idps.redact_log(log)
+  return result
+
+async def get_oauth_logs(user, id, params=None):
+  id = ObjectId(id)
+  await authorize_idp(user, id, 'You can\'t access this IdP')
+  return await query_logs(async_database.get_read_db().oauthRequests, id, params, None)
+
+async def query_logs(collection, id, params, projection, sp_names=None):
+  query, sort, limit = idps.log_query(id, params)
+  logs = collection.find(query, projection).sort(sort).limit(limit + 1).to_list(None)
+  if sp_names is None:
+    logs, sps = await asyncio.gather(logs, async_database.get_db().idpSps.find({'idp': id}, {'name': 1}).to_list(None))
+    sp_names = {sp['_id']: sp.get('name') for sp in sps}
+  else: logs = await logs
+  return idps.log_page(logs, limit, sort[0][1], params, sp_names)
+
+async def get_snapshot(user, id, params=None):
+  id = ObjectId(id)
+  params = params or {}
+  db = async_database.get_db()
+  sections = idps.snapshot_sections_from(params)
+  idp = await db.idps.aggregate(idps.snapshot_pipeline(id, sections)).to_list(1)
+  snapshot, sp_names = idps.snapshot_from(user, idp[0] if idp else None, sections)
+  read_db = async_database.get_read_db()
+  pages = {}
+  if 'saml2Logs' in sections: pages['saml2Logs'] = query_logs(read_db.requests, id, {}, {'data.assertion.key': 0}, sp_names)
+  if 'oauth2Logs' in sections: pages['oauth2Logs'] = query_logs(read_db.oauthRequests, id, {}, None, sp_names)
+  for section, page in zip(pages, await asyncio.gather(*pages.values())):
+    snapshot[section] = page
+  for log in snapshot.get('saml2Logs', {}).get('logs', []): idps.redact_log(log)
+
+  async def build():
+    if 'users' in sections: snapshot['users'] = await read_children('idpUsers', id, {}, snapshot['idp'].get('counts'))
+    return snapshot
+  return idps.snapshot_etag(id, sections, snapshot), build
+
+async def get_stats(user, id, params=None):
+  id = ObjectId(id)
+  params = params or {}
+  await authorize_idp(user, id, 'You can\'t access this IdP')
+  since, until, sp = idps.stats_range(params)
+  hours = await async_database.get_read_db().idpStats.find(stats.stats_query(id, since, until, sp), {'_id': 0, 'idp': 0, 'lastId': 0}).sort('hour', pymongo.ASCENDING).to_list(None)
+  return stats.summarize(hours, since, until)
@@ -0,0 +1,157 @@
+import os, re
+from urllib.parse import urlsplit, parse_qsl
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from werkzeug.routing import Map, Rule
+from werkzeug.datastructures import MultiDict
+from chalicelib.util import errors
+from chalicelib.api import users, idps
+
+max_operations = int(os.environ.get('BATCH_MAX_OPERATIONS', 100))
+rate_limit = os.environ.get('BATCH_RATE_LIMIT', '200 per minute')
+operation_id = re.compile(r'[A-Za-z0-9_-]+')
+# {{name}} is the _id of the result of the operation with that id, and {{name.field}} is another field of it
+reference = re.compile(r'\{\{\s*([A-Za-z0-9_-]+)((?:\.[A-Za-z0-9_-]+)*)\s*\}\}')
+
+def required(user):
+  if not user: raise errors.Unauthorized('This resource requires authentication')
+  return user
+
+# The operations a batch can contain. Account registration, login and password changes are left out, as they have their own rate limits.
+routes = Map([
+  Rule('/users/me', methods=['GET'], endpoint=lambda user, body, args: users.me(required(user))),
+  Rule('/users/<id>', methods=['PUT'], endpoint=lambda user, body, args, id: users.update(required(user), id, body)),
+  Rule('/idps', methods=['POST'], endpoint=lambda user, body, args: idps.create(user, body)),
+  Rule('/idps/<id>', methods=['GET'], endpoint=lambda user, body, args, id: idps.get_one(user, id)),
+  Rule('/idps/<id>', methods=['PUT'], endpoint=lambda user, body, args, id: idps.update(user, id, body)),
+  Rule('/idps/<id>', methods=['DELETE'], endpoint=lambda user, body, args, id: idps.delete(user, id)),
+  Rule('/idps/<id>/sps', methods=['GET'], endpoint=lambda user, body, args, id: idps.get_sps(user, id, args)),
+  Rule('/idps/<id>/sps', methods=['POST'], endpoint=lambda user, body, args, id: idps.create_sp(user, id, body)),
+  Rule('/idps/<id>/sps/<child_id>', methods=['PUT'], endpoint=lambda user, body, args, id, child_id: idps.update_sp(user, id, child_id, body)),
+  Rule('/idps/<id>/sps/<child_id>', methods=['DELETE'], endpoint=lambda user, body, args, id, child_id: idps.delete_sp(user, id, child_id)),
+  Rule('/idps/<id>/users', methods=['GET'], endpoint=lambda user, body, args, id: idps.get_users(user, id, args)),
+  Rule('/idps/<id>/users', methods=['POST'], endpoint=lambda user, body, args, id: idps.create_user(user, id, body)),
+  Rule('/idps/<id>/users/<child_id>', methods=['PUT'], endpoint=lambda user, body, args, id, child_id: idps.update_user(user, id, child_id, body)),
+  Rule('/idps/<id>/users/<child_id>', methods=['DELETE'], endpoint=lambda user, body, args, id, child_id: idps.delete_user(user, id, child_id)),
+  Rule('/idps/<id>/attributes', methods=['GET'], endpoint=lambda user, body, args, id: idps.get_attributes(user, id, args)),
+  Rule('/idps/<id>/attributes', methods=['POST'], endpoint=lambda user, body, args, id: idps.create_attribute(user, id, body)),
+  Rule('/idps/<id>/attributes/<child_id>', methods=['PUT'], endpoint=lambda user, body, args, id, child_id: idps.update_attribute(user, id, child_id, body)),
+  Rule('/idps/<id>/attributes/<child_id>', methods=['DELETE'], endpoint=lambda user, body, args, id, child_id: idps.delete_attribute(user, id, child_id)),
+], strict_slashes=False)
+
+# Consecutive creations in the same IdP list are written with one insert_many and one version bump
+bulk_creators = {
+  '/idps/<id>/sps': idps.create_sps,
+  '/idps/<id>/users': idps.create_users,
+  '/idps/<id>/attributes': idps.create_attributes,
+}
+
+def cost():
+  # Used as the rate limit cost, so each operation in a batch counts like a separate request
+  from flask import request
+  data = request.get_json(silent=True)
+  operations = data.get('operations') if isinstance(data, dict) else None
+  return min(max(len(operations), 1), max_operations) if isinstance(operations, list) else 1
+
+def run(user, data):
+  operations = validate(data)
+  results = [None] * len(operations)
+  completed = {}
+  group = []
+
+  def finish(index, status, body):
+    name = operations[index].get('id')
+    results[index] = {'id': name, 'status': status, 'body': body}
+    if name: completed[name] = (status, body)
+
+  def flush():
+    if not group: return
+    rule, id = group[0][1], group[0][2]
+    try:
+      items = call(lambda: bulk_creators[rule](user, id, [body for _, _, _, body in group]))
+    except Exception as e:
+      items = [e] * len(group)
+    for (index, _, _, _), item in zip(group, items): finish(index, *respond(item))
+    group.clear()
+
+  adapter = routes.bind('')
+  for index, operation in enumerate(operations):
+    # An operation can only refer to results that have been written
+    if set(referenced(operation)) & set(operations[pending[0]].get('id') for pending in group): flush()
+    try:
+      split = urlsplit(resolve_path(operation['path'], completed))
+      body = resolve(operation.get('body'), completed)
+      rule, view_args = adapter.match(split.path, method=operation['method'].upper(), return_rule=True)
+    except Exception as e:
+      flush()
+      finish(index, *respond(e))
+      continue
+
+    if operation['method'].upper() == 'POST' and rule.rule in bulk_creators:
+      if group and (group[0][1], group[0][2]) != (rule.rule, view_args['id']): flush()
+      group.append((index, rule.rule, view_args['id'], body))
+      continue
+    flush()
+    try:
+      finish(index, *respond(call(lambda: rule.endpoint(user, body, MultiDict(parse_qsl(split.query)), **view_args))))
+    except Exception as e:
+      finish(index, *respond(e))
+  flush()
+  return {'results': results}
+
+def validate(data):
+  operations = data.get('operations') if isinstance(data, dict) else None
+  if not isinstance(operations, list) or not operations: raise errors.BadRequest('A batch needs a list of operations')
+  if len(operations) > max_operations: raise errors.BadRequest('A batch can contain at most {0} operations'.format(max_operations))
+  names = set()
+  for operation in operations:
+    if not isinstance(operation, dict) or not isinstance(operation.get('method'), str) or not isinstance(operation.get('path'), str):
+      raise errors.BadRequest('Each operation needs a method and a path')
+    name = operation.get('id')
+    if name is not None and (not isinstance(name, str) or not operation_id.fullmatch(name)):
+      raise errors.BadRequest('Operation ids can only contain letters, numbers, dashes and underscores')
+    if name in names: raise errors.BadRequest('The operation id {0} is used more than once'.format(name))
+    if name: names.add(name)
+  return operations
+
+def call(function):
+  try:
+    return function()
+  except InvalidId as e:
+    # Raised by ObjectId() for malformed ids in the path
+    raise errors.BadRequest(str(e))
+
+def respond(result):
+  if isinstance(result, errors.HTTPException): return result.code, {'message': result.description}
+  if isinstance(result, Exception):
+    print(result)
+    return 500, {'message': 'The operation could not be completed'}
+  return 200, result
+
+def referenced(value):
+  if isinstance(value, str): return [match.group(1) for match in reference.finditer(value)]
+  if isinstance(value, dict): return [name for key, item in value.items() for name in referenced(key) + referenced(item)]
+  if isinstance(value, list): return [name for item in value for name in referenced(item)]
+  return []
+
+def lookup(match, completed):
+  name, fields = match.group(1), match.group(2).split('.')[1:] or ['_id']
+  if name not in completed: raise errors.BadRequest('{0} does not refer to an earlier operation'.format(match.group(0)))
+  status, value = completed[name]
+  if status != 200: raise errors.FailedDependency('The operation {0} did not succeed'.format(name))
+  for field in fields:
+    if not isinstance(value, dict) or field not in value: raise errors.BadRequest('The result of {0} has no field {1}'.format(name, '.'.join(fields)))
+    value = value[field]
+  return str(value) if isinstance(value, ObjectId) else value
+
+def resolve_path(path, completed):
+  return reference.sub(lambda match: str(lookup(match, completed)), path)
+
+def resolve(value, completed):
+  # Strings in bodies are only replaced when the whole string is a reference, so the referenced value keeps its type
+  if isinstance(value, str):
+    match = reference.fullmatch(value)
+    return lookup(match, completed) if match else value
+  if isinstance(value, dict): return {str(resolve(key, completed)): resolve(item, completed) for key, item in value.items()}
+  if isinstance(value, list): return [resolve(item, completed) for item in value]
+  return value
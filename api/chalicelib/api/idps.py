@@ -1,16 +1,37 @@
 from uuid import uuid4
-import bcrypt, re, random, string
-from OpenSSL import crypto
+import re, random, string, os, csv, json, codecs, datetime
 import pymongo
 from bson.objectid import ObjectId
-from chalicelib.util import database, errors
-
+from chalicelib.util import database, errors, keypool, hashing, util, stats, cascade, owners, metrics
+
+import_batch_size = int(os.environ.get('IMPORT_BATCH_SIZE', 200))
+max_log_page_size = 100
+max_child_page_size = 500
+search_count_limit = 1000
+export_batch_size = int(os.environ.get('EXPORT_BATCH_SIZE', 500))
+max_export_size = int(os.environ.get('EXPORT_MAX_DOCUMENTS', 100000))
+snapshot_sections = ['sps', 'users', 'attributes', 'saml2Logs', 'oauth2Logs']
+# The test users and attribute every new IdP starts with
+seed_password = 'password'
+seed_users = [
+  {'email': 'joe@example.com', 'firstName': 'Joe', 'lastName': 'Bloggs'},
+  {'email': 'jane@example.com', 'firstName': 'Jane', 'lastName': 'Doe'},
+]
+seed_attributes = [{'name': 'Group', 'defaultValue': 'staff', 'samlMapping': 'group'}]
 forbidden_codes = ['', 'app', 'my', 'www', 'support', 'mail', 'email', 'dashboard', 'ssotools', 'myidp']
 
+# How each child list is paginated. Every sort field has an {idp, field, _id} index, and the first one is the default.
+child_lists = {
+  'idpUsers': {'section': 'users', 'sorts': ['email', 'firstName', 'lastName'], 'fields': ['firstName', 'lastName', 'email', 'attributes'], 'projection': {'firstName': 1, 'lastName': 1, 'email': 1, 'attributes': 1}, 'searchable': True},
+  'idpSps': {'section': 'sps', 'sorts': ['name'], 'fields': ['name', 'type', 'entityId', 'serviceUrl', 'callbackUrl', 'logoutUrl', 'logoutCallbackUrl', 'oauth2ClientId', 'oauth2ClientSecret', 'oauth2RedirectUri'], 'projection': None, 'searchable': False},
+  'idpAttributes': {'section': 'attributes', 'sorts': ['name'], 'fields': ['name', 'defaultValue', 'samlMapping'], 'projection': None, 'searchable': False},
+}
+
+@metrics.timed('certificate')
 def create_self_signed_cert(name):
-  # create a key pair
-  k = crypto.PKey()
-  k.generate_key(crypto.TYPE_RSA, 1024)
+  from OpenSSL import crypto
+  # claim a pre-generated key pair, or create one if the pool is empty
+  k = keypool.claim() or keypool.generate_key()
 
   # create a self-signed cert
   cert = crypto.X509()
@@ -31,6 +52,70 @@ def can_manage_idp(user, idp):
   if not user: return not idp.get('user')
   if user: return idp.get('user') == user['_id'] or not idp.get('user')
 
+def authorize_idp(user, id, message):
+  owner = owners.get_idp_owner(id)
+  if owner is owners.missing: raise errors.NotFound('The IdP could not be found')
+  if owner and (not user or owner != user['_id']): raise errors.Forbidden(message)
+
+def insert_children(collection, id, section, children):
+  # One insert and one version bump for any number of new children. insert_many sets each child's _id.
+  # Returns the errors of the children that could not be written, by their index
+  failed = {}
+  if not children: return failed
+  try:
+    collection.insert_many(children, ordered=False)
+  except pymongo.errors.BulkWriteError as e:
+    failed = {error['index']: (errors.Conflict if error['code'] == 11000 else errors.BadRequest)(error['errmsg']) for error in e.details['writeErrors']}
+  if len(failed) < len(children) and not bump_version(id, {section: len(children) - len(failed)}):
+    remove_orphans(collection, id, [child['_id'] for child in children])
+    raise errors.NotFound('The IdP could not be found')
+  return failed
+
+def remove_orphans(collection, id, child_ids):
+  # The owner check can pass from another worker's cache after the IdP was deleted. The version bump then matches nothing, and the new children are removed again.
+  collection.delete_many({'_id': {'$in': child_ids}, 'idp': id})
+  owners.invalidate_idp(id)
+
+def single(results):
+  # The single-item creators share the bulk code, and raise the item's error instead of returning it
+  if isinstance(results[0], errors.HTTPException): raise results[0]
+  return results[0]
+
+def update_child(collection, id, child_id, data, fields, projection=None, derived=None, unchanged=None):
+  # The IdP is part of the filter, so the ownership check and the write happen in one round trip
+  # derived fields are set in the same update, and unchanged holds the values they were computed from, which the child must still have
+  update_data = {field: data[field] for field in fields if field in (data or {})}
+  if not update_data: return collection.find_one({'_id': child_id, 'idp': id}, projection)
+  child = collection.find_one_and_update(dict(unchanged or {}, _id=child_id, idp=id), {'$set': dict(update_data, **(derived or {}))}, projection, return_document=pymongo.ReturnDocument.AFTER)
+  if child: bump_version(id)
+  return child
+
+def bump_version(id, counts=None):
+  # counts adjusts the IdP's maintained child totals, such as {'users': 1} after an insert
+  increments = {'version': 1}
+  for section, change in (counts or {}).items(): increments['counts.' + section] = change
+  return database.get_db().idps.update_one({'_id': id}, {'$inc': increments}).matched_count > 0
+
+def get_version(user, id):
+  idp = database.get_db().idps.find_one({'_id': ObjectId(id)}, {'user': 1, 'version': 1})
+  if not idp: raise errors.NotFound('The IdP could not be found')
+  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t view this IdP')
+  return idp.get('version', 0)
+
+def get_etag(user, id, resource, params=None):
+  # IdP resources change only through this module, which bumps the IdP's version on every write
+  return util.etag(str(id), resource, params or {}, get_version(user, id))
+
+def get_logs_etag(user, id, kinds, params=None):
+  # Logs are written by the IdP service, so the newest log in each collection is part of the validator
+  db = database.get_read_db()
+  newest = []
+  for kind in kinds:
+    collection = db.requests if kind == 'saml2' else db.oauthRequests
+    log = next(collection.find({'idp': ObjectId(id)}, {'createdAt': 1}).sort([('createdAt', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]).limit(1), None)
+    newest.append(util.encode_cursor(log) if log else None)
+  return util.etag(get_etag(user, id, 'logs:' + ','.join(kinds), params), newest)
+
 def create(user, data):
   db = database.get_db()
   if not data or not data.get('code') or not data.get('name'): return errors.BadRequest('Name and issuer are required')
@@ -40,25 +125,35 @@ def create(user, data):
     raise errors.BadRequest('The issuer is invalid or is already in use')
   if not re.match(r'^([a-zA-Z0-9\-_]+)$', code): raise errors.BadRequest('The IdP issuer is invalid. Please just use letters, numbers, hyphens, and underscores.')
 
-  x509 = create_self_signed_cert(data['name'])
+  idp = new_idp(user, data, code, create_self_signed_cert(data['name']))
+  result = db.idps.insert_one(idp)
+  idp['_id'] = result.inserted_id
+
+  new_users, new_attributes = seed_children(idp['_id'], hashing.hash_password(seed_password, 'idpUsers', True))
+  db.idpUsers.insert_many(new_users)
+  db.idpAttributes.insert_many(new_attributes)
+  return idp
+
+def new_idp(user, data, code, x509):
+  # Shared with the ASGI app. The counts already include the seeded children.
   idp = {
     'name': data.get('name'),
     'code': code,
+    'version': 1,
+    'counts': {'sps': 0, 'users': len(seed_users), 'attributes': len(seed_attributes)},
     'saml': {
       'certificate': x509['cert'].decode('utf-8'),
       'privateKey': x509['key'].decode('utf-8')
     }
   }
   if user: idp['user'] = user['_id']
-  result = db.idps.insert_one(idp)
-  idp['_id'] = result.inserted_id
-
-  create_user(user, idp['_id'], {'email': 'joe@example.com', 'firstName': 'Joe', 'lastName': 'Bloggs', 'password': 'password'})
-  create_user(user, idp['_id'], {'email': 'jane@example.com', 'firstName': 'Jane', 'lastName': 'Doe', 'password': 'password'})
-  create_attribute(user, idp['_id'], {'name': 'Group', 'defaultValue': 'staff', 'samlMapping': 'group'})
-
   return idp
 
+def seed_children(id, hashed_password):
+  new_users = [dict(seed_user, password=hashed_password, attributes={}, idp=id) for seed_user in seed_users]
+  for new_user in new_users: new_user['searchKeys'] = search_keys(new_user)
+  return new_users, [dict(seed_attribute, idp=id) for seed_attribute in seed_attributes]
+
 def get(user, include):
   db = database.get_db()
   if include: include = list(map(lambda i: ObjectId(i), include.split(',')))
@@ -66,7 +161,7 @@ def get(user, include):
 
   if user: query = {'$or': [{'user': user['_id']}, {'_id': {'$in': include}, 'user': {'$exists': False}}]}
   else: query = {'_id': {'$in': include}, 'user': {'$exists': False}}
-  idps = list(db.idps.find(query, {'name': 1, 'code': 1}))
+  idps = list(db.idps.find(query, {'name': 1, 'code': 1, 'version': 1}))
   return {'idps': idps}
 
 def get_one(user, id):
@@ -75,49 +170,47 @@ def get_one(user, id):
   idp = db.idps.find_one(id)
   if not idp: raise errors.NotFound('The IdP could not be found')
   if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t view this IdP')
-  idp['users'] = list(db.idpUsers.find({'idp': idp['_id']}, {'firstName': 1, 'lastName': 1, 'email': 1}))
   return idp
 
 def update(user, id, data):
   id = ObjectId(id)
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t edit this IdP')
+  authorize_idp(user, id, 'You can\'t edit this IdP')
 
+  data = data or {}
+  update_data = {}
   if 'code' in data:
     code = data.get('code').lower().strip()
     if not len(code) or code in forbidden_codes or db.idps.find_one({'code': code, '_id': {'$ne': id}}):
       raise errors.BadRequest('This code is invalid or is already in use')
     if not re.match(r'^([a-zA-Z0-9\-_]+)$', code): raise errors.BadRequest('The IdP issuer is invalid. Please just use letters, numbers, hyphens, and underscores.')
-  else: code = idp['code']
-  update_data = {
-    'name': data.get('name', idp['name']),
-    'code': code
-  }
-  db.idps.update_one({'_id': id}, {'$set': update_data})
+    update_data['code'] = code
+  if 'name' in data: update_data['name'] = data['name']
+  if update_data: db.idps.update_one({'_id': id}, {'$set': update_data, '$inc': {'version': 1}})
   return get_one(user, id)
 
 def delete(user, id):
   id = ObjectId(id)
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t delete this IdP')
+  authorize_idp(user, id, 'You can\'t delete this IdP')
   db.idps.remove({'_id': id })
+  owners.invalidate_idp(id)
+  cascade.enqueue([id])
   return {'deletedIDP': id}
 
 
 #### SPs
 
 def create_sp(user, id, data):
+  return single(create_sps(user, id, [data]))
+
+def create_sps(user, id, items):
   id = ObjectId(id)
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t manage this IdP')
+  authorize_idp(user, id, 'You can\'t manage this IdP')
 
-  sp = {
+  items = [data or {} for data in items]
+  sps = [{
     'name': data.get('name'),
     'type': 'saml',
     'entityId': data.get('entityId'),
@@ -129,220 +222,439 @@ def create_sp(user, id, data):
     'oauth2ClientSecret': str(''.join(random.choices(string.ascii_uppercase + string.digits, k=32))),
     'oauth2RedirectUri': data.get('oauth2RedirectUri'),
     'idp': id
-  }
-  result = db.idpSps.insert_one(sp)
-  sp['_id'] = result.inserted_id
-  return sp
+  } for data in items]
+  failed = insert_children(db.idpSps, id, 'sps', sps)
+  return [failed.get(index, sp) for index, sp in enumerate(sps)]
 
 def update_sp(user, id, sp_id, data):
   id = ObjectId(id)
   sp_id = ObjectId(sp_id)
   db = database.get_db()
-  existing = db.idpSps.find_one(sp_id)
-  if not existing: return errors.NotFound('SP not found')
-  idp = db.idps.find_one(existing['idp'])
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
-
-  update_data = {
-    'name': data.get('name'),
-    'entityId': data.get('entityId'),
-    'serviceUrl': data.get('serviceUrl'),
-    'callbackUrl': data.get('callbackUrl'),
-    'logoutUrl': data.get('logoutUrl'),
-    'logoutCallbackUrl': data.get('logoutCallbackUrl'),
-    'oauth2RedirectUri': data.get('oauth2RedirectUri'),
-  }
-  db.idpSps.update({'_id': sp_id}, {'$set': update_data})
-  return db.idpSps.find_one({'_id': sp_id}, {'name': 1, 'entityId': 1, 'serviceUrl': 1, 'callbackUrl': 1, 'logoutUrl': 1, 'logoutCallbackUrl': 1})
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-def get_sps(user, id):
-  id = ObjectId(id)
-  db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
+  fields = ['name', 'entityId', 'serviceUrl', 'callbackUrl', 'logoutUrl', 'logoutCallbackUrl', 'oauth2RedirectUri']
+  # Sent fields are replaced as a whole, as before, so a missing value clears the field
+  sp = update_child(db.idpSps, id, sp_id, {field: (data or {}).get(field) for field in fields}, fields, {'name': 1, 'entityId': 1, 'serviceUrl': 1, 'callbackUrl': 1, 'logoutUrl': 1, 'logoutCallbackUrl': 1})
+  if not sp: raise errors.NotFound('SP not found')
+  return sp
 
-  sps = list(db.idpSps.find({'idp': id}))
-  return {'sps': sps}
+def get_sps(user, id, params=None):
+  return list_children(user, id, 'idpSps', params, 'You can\'t update this IdP')
 
 def delete_sp(user, id, sp_id):
   id = ObjectId(id)
   sp_id = ObjectId(sp_id)
   db = database.get_db()
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-  existing = db.idpSps.find_one(sp_id)
-  if not existing: return errors.NotFound('SP not found')
-
-  idp = db.idps.find_one(existing['idp'])
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
-
-  db.idpSps.remove({'_id': sp_id})
+  if not db.idpSps.delete_one({'_id': sp_id, 'idp': id}).deleted_count: raise errors.NotFound('SP not found')
+  bump_version(id, {'sps': -1})
   return {'deletedIDPSP': sp_id}
 
 
 #### Users
 
 def create_user(user, id, data):
+  return single(create_users(user, id, [data]))
+
+def create_users(user, id, items):
   id = ObjectId(id)
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-  password = data['password']
-  hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
-  new_user = {
+  results = [data if data and data.get('email') and data.get('password') else errors.BadRequest('Each user needs an email and password') for data in items]
+  valid = [data for data in results if not isinstance(data, errors.HTTPException)]
+  # Passwords are hashed together, so a batch of users spreads over the whole hashing pool
+  hashes = hashing.hash_passwords([data['password'] for data in valid], 'idpUsers') if valid else []
+  new_users = [{
     'firstName': data.get('firstName'),
     'lastName': data.get('lastName'),
     'email': data['email'],
     'password': hashed_password,
     'attributes': data.get('attributes', {}),
     'idp': id
-  }
-
-  result = db.idpUsers.insert_one(new_user)
-  new_user['_id'] = result.inserted_id
-  del new_user['password']
-  return new_user
+  } for data, hashed_password in zip(valid, hashes)]
+  for new_user in new_users: new_user['searchKeys'] = search_keys(new_user)
+
+  failed = insert_children(db.idpUsers, id, 'users', new_users)
+  created = iter([failed.get(index, new_user) for index, new_user in enumerate(new_users)])
+  results = [result if isinstance(result, errors.HTTPException) else next(created) for result in results]
+  for new_user in new_users:
+    del new_user['password']
+    del new_user['searchKeys']
+  return results
+
+def import_users(user, id, stream, content_type):
+  id = ObjectId(id)
+  authorize_idp(user, id, 'You can\'t update this IdP')
+  if 'csv' not in (content_type or '') and 'ndjson' not in (content_type or ''):
+    raise errors.BadRequest('Users must be uploaded as text/csv or application/x-ndjson')
+
+  def results():
+    batch = []
+    for row in read_import_rows(stream, content_type):
+      batch.append(row)
+      if len(batch) >= import_batch_size:
+        yield from import_user_batch(id, batch)
+        batch = []
+    if batch: yield from import_user_batch(id, batch)
+  return results()
+
+def read_import_rows(stream, content_type):
+  lines = codecs.iterdecode(stream, 'utf-8')
+  if 'csv' in content_type:
+    for number, row in enumerate(csv.DictReader(lines), start=1):
+      yield number, row
+    return
+  for number, line in enumerate(lines, start=1):
+    if not line.strip(): continue
+    try:
+      yield number, json.loads(line)
+    except ValueError:
+      yield number, None
+
+def import_user_batch(id, batch):
+  results = {}
+  valid = []
+  for number, row in batch:
+    if not isinstance(row, dict):
+      results[number] = {'row': number, 'status': 'error', 'message': 'This row could not be parsed'}
+    elif not row.get('email') or not row.get('password'):
+      results[number] = {'row': number, 'status': 'error', 'message': 'Each user needs an email and password'}
+    else: valid.append((number, row))
+  try:
+    hashes = hashing.hash_passwords([row['password'] for _, row in valid], 'idpUsers') if valid else []
+  except errors.ServiceUnavailable as e:
+    for number, _ in valid: results[number] = {'row': number, 'status': 'error', 'message': e.description}
+    valid = []
+  new_users = [{
+    'firstName': row.get('firstName'),
+    'lastName': row.get('lastName'),
+    'email': row['email'].lower().strip(),
+    'password': hashed_password,
+    'attributes': row.get('attributes') if isinstance(row.get('attributes'), dict) else {},
+    'idp': id
+  } for (_, row), hashed_password in zip(valid, hashes)]
+  for new_user in new_users: new_user['searchKeys'] = search_keys(new_user)
+
+  try:
+    failed = {index: e.description for index, e in insert_children(database.get_db().idpUsers, id, 'users', new_users).items()}
+  except errors.NotFound as e:
+    failed = {index: e.description for index in range(len(new_users))}
+  for index, ((number, _), new_user) in enumerate(zip(valid, new_users)):
+    if index in failed: results[number] = {'row': number, 'status': 'error', 'message': failed[index]}
+    else: results[number] = {'row': number, 'status': 'created', '_id': new_user['_id'], 'email': new_user['email']}
+  for number, _ in batch: yield results[number]
 
 def update_user(user, id, user_id, data):
   id = ObjectId(id)
   user_id = ObjectId(user_id)
   db = database.get_db()
-  existing = db.idpUsers.find_one(user_id)
-  if not existing: return errors.NotFound('User not found')
-  idp = db.idps.find_one(existing['idp'])
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
-
-  update_data = {
-    'firstName': data.get('firstName', existing.get('firstName')),
-    'lastName': data.get('lastName', existing.get('lastName')),
-    'email': data.get('email', existing.get('email')),
-    'attributes': data.get('attributes', existing.get('attributes', {}))
-  }
-  if data.get('password'):
-    hashed_password = bcrypt.hashpw(data['password'].encode("utf-8"), bcrypt.gensalt())
-    update_data['password'] = hashed_password
-  db.idpUsers.update({'_id': user_id}, {'$set': update_data})
-  return db.idpUsers.find_one({'_id': user_id}, {'firstName': 1, 'lastName': 1, 'email': 1, 'attributes': 1})
-
-def get_users(user, id):
-  id = ObjectId(id)
-  db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t manage this IdP')
-
-  users = list(db.idpUsers.find({'idp': id}, {'firstName': 1, 'lastName': 1, 'email': 1, 'attributes': 1}))
-  return {'users': users}
+  authorize_idp(user, id, 'You can\'t update this IdP')
+
+  data = dict(data or {})
+  # An empty password is ignored, as the IdP can't log in a user without one
+  if data.get('password'): data['password'] = hashing.hash_password(data['password'], 'idpUsers')
+  else: data.pop('password', None)
+  fields = ['firstName', 'lastName', 'email', 'attributes', 'password']
+  projection = {'firstName': 1, 'lastName': 1, 'email': 1, 'attributes': 1}
+  name_fields = [field for field in ('firstName', 'lastName', 'email') if field not in data]
+  if len(name_fields) == 3: idp_user = update_child(db.idpUsers, id, user_id, data, fields, projection)
+  else:
+    # searchKeys is written with the names. It also depends on the names not being updated, so the write is retried if they change after being read.
+    while True:
+      current = db.idpUsers.find_one({'_id': user_id, 'idp': id}, {field: 1 for field in name_fields}) if name_fields else {}
+      if current is None: raise errors.NotFound('User not found')
+      unchanged = {field: current.get(field) for field in name_fields}
+      idp_user = update_child(db.idpUsers, id, user_id, data, fields, projection, {'searchKeys': search_keys(dict(unchanged, **data))}, unchanged)
+      if idp_user or not unchanged: break
+  if not idp_user: raise errors.NotFound('User not found')
+  return idp_user
+
+def search_keys(idp_user):
+  # ?q= matches prefixes of these lowercased values, so searches use the {idp, searchKeys} index
+  first_name, last_name, email = [str(idp_user.get(field) or '').lower().strip() for field in ('firstName', 'lastName', 'email')]
+  return sorted(set(key for key in [email, first_name, last_name, (first_name + ' ' + last_name).strip()] if key))
+
+def get_users(user, id, params=None):
+  return list_children(user, id, 'idpUsers', params, 'You can\'t manage this IdP')
 
 def delete_user(user, id, user_id):
   id = ObjectId(id)
   user_id = ObjectId(user_id)
   db = database.get_db()
-  existing = db.idpUsers.find_one(user_id)
-  if not existing: return errors.NotFound('User not found')
-  idp = db.idps.find_one(existing['idp'])
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-  db.idpUsers.remove({'_id': user_id})
+  if not db.idpUsers.delete_one({'_id': user_id, 'idp': id}).deleted_count: raise errors.NotFound('User not found')
+  bump_version(id, {'users': -1})
   return {'deletedUser': user_id}
 
 
 #### Attributes
 
 def create_attribute(user, id, data):
+  return single(create_attributes(user, id, [data]))
+
+def create_attributes(user, id, items):
   id = ObjectId(id)
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
-  if not data or 'name' not in data: return errors.BadRequest('Attribute name is required')
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-  new_attr = {
+  results = [{
     'name': data.get('name'),
     'defaultValue': data.get('defaultValue'),
     'samlMapping': data.get('samlMapping'),
     'idp': id
-  }
-
-  result = db.idpAttributes.insert_one(new_attr)
-  new_attr['_id'] = result.inserted_id
-  return new_attr
+  } if data and 'name' in data else errors.BadRequest('Attribute name is required') for data in items]
+  valid = [index for index, result in enumerate(results) if not isinstance(result, errors.HTTPException)]
+  failed = insert_children(db.idpAttributes, id, 'attributes', [results[index] for index in valid])
+  for index, error in failed.items(): results[valid[index]] = error
+  return results
 
 def update_attribute(user, id, attr_id, data):
   id = ObjectId(id)
   attr_id = ObjectId(attr_id)
   db = database.get_db()
-  existing = db.idpAttributes.find_one(attr_id)
-  if not existing: return errors.NotFound('Attribute not found')
-  idp = db.idps.find_one(existing['idp'])
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
-
-  update_data = {
-    'name': data.get('name', existing.get('name')),
-    'defaultValue': data.get('defaultValue', existing.get('defaultValue')),
-    'samlMapping': data.get('samlMapping', existing.get('samlMapping')),
-  }
-  db.idpAttributes.update({'_id': attr_id}, {'$set': update_data})
-  return db.idpAttributes.find_one({'_id': attr_id})
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-def get_attributes(user, id):
-  id = ObjectId(id)
-  db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t manage this IdP')
+  attribute = update_child(db.idpAttributes, id, attr_id, data, ['name', 'defaultValue', 'samlMapping'])
+  if not attribute: raise errors.NotFound('Attribute not found')
+  return attribute
 
-  attributes = list(db.idpAttributes.find({'idp': id}))
-  return {'attributes': attributes}
+def get_attributes(user, id, params=None):
+  return list_children(user, id, 'idpAttributes', params, 'You can\'t manage this IdP')
 
 def delete_attribute(user, id, attr_id):
   id = ObjectId(id)
   attr_id = ObjectId(attr_id)
   db = database.get_db()
-  existing = db.idpAttributes.find_one(attr_id)
-  if not existing: return errors.NotFound('Attribute not found')
-  idp = db.idps.find_one(existing['idp'])
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t update this IdP')
+  authorize_idp(user, id, 'You can\'t update this IdP')
 
-  db.idpAttributes.remove({'_id': attr_id})
+  if not db.idpAttributes.delete_one({'_id': attr_id, 'idp': id}).deleted_count: raise errors.NotFound('Attribute not found')
+  bump_version(id, {'attributes': -1})
   return {'deletedAttribute': attr_id}
 
-def get_logs(user, id):
+
+#### Child lists
+
+def list_children(user, id, collection, params, message):
   id = ObjectId(id)
+  authorize_idp(user, id, message)
+  return read_children(database.get_db(), collection, id, params)
+
+def read_children(db, collection, id, params, counts=None):
+  # counts are the IdP's child totals when the caller has already read the IdP
+  query, sort, limit, projection, count_query = child_query(collection, id, params)
+  children = list(db[collection].find(query, projection).sort(sort).limit(limit + 1))
+  return child_page(collection, children, limit, sort, count_children(db, collection, id, count_query, counts), count_query is not None)
+
+def count_children(db, collection, id, count_query, counts=None):
+  if count_query is not None: return db[collection].count_documents(count_query, limit=search_count_limit)
+  if counts is None: counts = (db.idps.find_one({'_id': id}, {'counts': 1}) or {}).get('counts', {})
+  total = counts.get(child_lists[collection]['section'])
+  return total if total is not None else db[collection].count_documents({'idp': id})
+
+def child_query(collection, id, params):
+  # Returns the page query, sort, limit and projection, and the query to count when the total can't come from the IdP's counters
+  params = params or {}
+  options = child_lists[collection]
+  try:
+    limit = min(max(int(params.get('limit', 100)), 1), max_child_page_size)
+  except ValueError:
+    raise errors.BadRequest('The limit must be a number')
+  sort = params.get('sort') or options['sorts'][0]
+  if sort not in options['sorts']: raise errors.BadRequest('Results can only be sorted by ' + ', '.join(options['sorts']))
+  projection = options['projection']
+  if params.get('fields'):
+    fields = params['fields'].split(',')
+    unknown = [field for field in fields if field not in options['fields']]
+    if unknown: raise errors.BadRequest('Unknown fields: ' + ', '.join(unknown))
+    projection = {field: 1 for field in fields + [sort]}
+
+  query = {'idp': id}
+  count_query = None
+  if params.get('q'):
+    if not options['searchable']: raise errors.BadRequest('This list can\'t be searched')
+    query['searchKeys'] = {'$regex': '^' + re.escape(params['q'].lower().strip())}
+    count_query = query
+  if params.get('after'): query = {'$and': [query, util.sort_key_filter(sort, params['after'])]}
+  return query, [(sort, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], limit, projection, count_query
+
+def migrate_child_counts():
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t access this IdP')
-  logs = list(db.requests.find({'idp': id}).sort('createdAt', pymongo.DESCENDING).limit(30))
-  sps = list(db.idpSps.find({'idp': id}, {'name': 1}))
+  migrated = 0
+  for idp in db.idps.find({'$or': [{'counts.' + options['section']: {'$exists': False}} for options in child_lists.values()]}, {'_id': 1}):
+    counts = {child_lists[collection]['section']: db[collection].count_documents({'idp': idp['_id']}) for collection in child_lists}
+    db.idps.update_one({'_id': idp['_id']}, {'$set': {'counts': counts}, '$inc': {'version': 1}})
+    migrated += 1
+  return {'migrated': migrated}
+
+def migrate_user_search_keys():
+  db = database.get_db()
+  migrated = 0
+  while True:
+    batch = list(db.idpUsers.find({'searchKeys': {'$exists': False}}, {'firstName': 1, 'lastName': 1, 'email': 1}).limit(import_batch_size))
+    if not batch: return {'migrated': migrated}
+    db.idpUsers.bulk_write([pymongo.UpdateOne({'_id': idp_user['_id']}, {'$set': {'searchKeys': search_keys(idp_user)}}) for idp_user in batch], ordered=False)
+    migrated += len(batch)
+
+def child_page(collection, children, limit, sort, total, searched):
+  has_more = len(children) > limit
+  children = children[:limit]
+  return {
+    child_lists[collection]['section']: children,
+    'total': total,
+    # Search totals stop counting at search_count_limit
+    'totalCapped': searched and total >= search_count_limit,
+    'cursors': {'after': util.encode_sort_cursor(sort[0][0], children[-1]) if has_more else None},
+  }
+
+
+#### Logs
+
+def get_logs(user, id, params=None):
+  id = ObjectId(id)
+  db = database.get_read_db()
+  authorize_idp(user, id, 'You can\'t access this IdP')
+  result = query_logs(db.requests, id, params or {}, {'data.assertion.key': 0})
+  for log in result['logs']: redact_log(log)
+  return result
+
+def redact_log(log):
+  if log.get('type') == 'loginResponse' and isinstance(log.get('data', {}).get('assertion'), dict):
+    log['data']['assertion']['key'] = 'REDACTED'
+
+def get_oauth_logs(user, id, params=None):
+  id = ObjectId(id)
+  db = database.get_read_db()
+  authorize_idp(user, id, 'You can\'t access this IdP')
+  return query_logs(db.oauthRequests, id, params, None)
+
+def query_logs(collection, id, params, projection, sp_names=None):
+  query, sort, limit = log_query(id, params)
+  logs = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+  if sp_names is None: sp_names = {sp['_id']: sp.get('name') for sp in database.get_db().idpSps.find({'idp': id}, {'name': 1})}
+  return log_page(logs, limit, sort[0][1], params, sp_names)
+
+def log_query(id, params):
+  params = params or {}
+  try:
+    limit = min(max(int(params.get('limit', 30)), 1), max_log_page_size)
+  except ValueError:
+    raise errors.BadRequest('The limit must be a number')
+  query = {'idp': id}
+  if params.get('sp'): query['sp'] = util.parse_object_id(params['sp'])
+  if params.get('type'): query['type'] = params['type']
+  if params.get('since') or params.get('until'):
+    query['createdAt'] = {}
+    if params.get('since'): query['createdAt']['$gte'] = util.parse_datetime(params['since'])
+    if params.get('until'): query['createdAt']['$lt'] = util.parse_datetime(params['until'])
+
+  direction = pymongo.DESCENDING
+  if params.get('after'):
+    direction = pymongo.ASCENDING
+    query = {'$and': [query, util.keyset_filter(params['after'], '$gt')]}
+  elif params.get('before'):
+    query = {'$and': [query, util.keyset_filter(params['before'], '$lt')]}
+  return query, [('createdAt', direction), ('_id', direction)], limit
+
+def log_page(logs, limit, direction, params, sp_names):
+  params = params or {}
+  has_more = len(logs) > limit
+  logs = logs[:limit]
+  if direction == pymongo.ASCENDING: logs.reverse()
   for log in logs:
-    if log.get('data', {}).get('assertion', {}).get('key'):
-      log['data']['assertion']['key'] = 'REDACTED'
-    for sp in sps:
-      if log['sp'] == sp['_id']:
-        log['spName'] = sp['name']
-        break
-  return {'logs': logs}
-
-def get_oauth_logs(user, id):
+    if log.get('sp') in sp_names: log['spName'] = sp_names[log['sp']]
+
+  older = has_more or direction == pymongo.ASCENDING
+  return {'logs': logs, 'cursors': {
+    'before': util.encode_cursor(logs[-1]) if logs and older else None,
+    'after': util.encode_cursor(logs[0]) if logs else params.get('after'),
+  }}
+
+def export_logs(user, id, kind, params=None):
   id = ObjectId(id)
+  params = params or {}
   db = database.get_db()
-  idp = db.idps.find_one(id)
-  if not idp: return errors.NotFound('IDP not found')
-  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t access this IdP')
-  logs = list(db.oauthRequests.find({'idp': id}).sort('createdAt', pymongo.DESCENDING).limit(30))
-  sps = list(db.idpSps.find({'idp': id}, {'name': 1}))
-  for log in logs:
-    for sp in sps:
-      if log['sp'] == sp['_id']:
-        log['spName'] = sp['name']
-        break
-  return {'logs': logs}
\ No newline at end of file
+  authorize_idp(user, id, 'You can\'t access this IdP')
+  try:
+    limit = min(max(int(params.get('limit', max_export_size)), 1), max_export_size)
+  except ValueError:
+    raise errors.BadRequest('The limit must be a number')
+
+  query = {'idp': id}
+  if params.get('since'): query = {'$and': [query, util.keyset_filter(params['since'], '$gt')]}
+  read_db = database.get_read_db()
+  collection = read_db.requests if kind == 'saml2' else read_db.oauthRequests
+  projection = {'data.assertion.key': 0} if kind == 'saml2' else None
+  cursor = collection.find(query, projection).sort([('createdAt', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]).batch_size(export_batch_size).limit(limit)
+  sp_names = {sp['_id']: sp.get('name') for sp in db.idpSps.find({'idp': id}, {'name': 1})}
+
+  def logs():
+    for log in cursor:
+      redact_log(log)
+      if log.get('sp') in sp_names: log['spName'] = sp_names[log['sp']]
+      log['cursor'] = util.encode_cursor(log)
+      yield log
+  return logs()
+
+def get_snapshot(user, id, params=None):
+  # Returns the ETag and a function that completes the snapshot, so a matching If-None-Match skips the users page
+  id = ObjectId(id)
+  params = params or {}
+  db = database.get_db()
+  sections = snapshot_sections_from(params)
+  idp = next(db.idps.aggregate(snapshot_pipeline(id, sections)), None)
+  snapshot, sp_names = snapshot_from(user, idp, sections)
+  read_db = database.get_read_db()
+  if 'saml2Logs' in sections:
+    snapshot['saml2Logs'] = query_logs(read_db.requests, id, {}, {'data.assertion.key': 0}, sp_names)
+    for log in snapshot['saml2Logs']['logs']: redact_log(log)
+  if 'oauth2Logs' in sections:
+    snapshot['oauth2Logs'] = query_logs(read_db.oauthRequests, id, {}, None, sp_names)
+
+  def build():
+    if 'users' in sections: snapshot['users'] = read_children(db, 'idpUsers', id, {}, snapshot['idp'].get('counts'))
+    return snapshot
+  return snapshot_etag(id, sections, snapshot), build
+
+def snapshot_sections_from(params):
+  sections = params['sections'].split(',') if params.get('sections') else snapshot_sections
+  unknown = [section for section in sections if section not in snapshot_sections]
+  if unknown: raise errors.BadRequest('Unknown snapshot sections: ' + ', '.join(unknown))
+  return sections
+
+def snapshot_pipeline(id, sections):
+  # One aggregation returns the IdP with its children, so ownership is checked on the same read
+  with_logs = 'saml2Logs' in sections or 'oauth2Logs' in sections
+  pipeline = [{'$match': {'_id': id}}]
+  # Users can number in the thousands, so they are read separately as the first page of the users list
+  for section, collection in [('sps', 'idpSps'), ('attributes', 'idpAttributes')]:
+    if section in sections or (section == 'sps' and with_logs):
+      pipeline.append({'$lookup': {'from': collection, 'localField': '_id', 'foreignField': 'idp', 'as': section}})
+  return pipeline
+
+def snapshot_etag(id, sections, snapshot):
+  # The IdP's version covers its children. The log pages are newest first, so their after cursors identify the newest logs.
+  return util.etag(str(id), 'snapshot', sections, snapshot['idp'].get('version', 0), [snapshot[section]['cursors']['after'] for section in ['saml2Logs', 'oauth2Logs'] if section in snapshot])
+
+def snapshot_from(user, idp, sections):
+  if not idp: raise errors.NotFound('The IdP could not be found')
+  if not can_manage_idp(user, idp): raise errors.Forbidden('You can\'t view this IdP')
+  snapshot = {section: idp.pop(section) for section in ['sps', 'attributes'] if section in idp}
+  sp_names = {sp['_id']: sp.get('name') for sp in snapshot.get('sps', [])}
+  if 'sps' not in sections: snapshot.pop('sps', None)
+  snapshot['idp'] = idp
+  return snapshot, sp_names
+
+def get_stats(user, id, params=None):
+  id = ObjectId(id)
+  params = params or {}
+  authorize_idp(user, id, 'You can\'t access this IdP')
+  return stats.get_stats(id, *stats_range(params))
+
+def stats_range(params):
+  until = util.parse_datetime(params['until']) if params.get('until') else datetime.datetime.utcnow()
+  since = util.parse_datetime(params['since']) if params.get('since') else until - datetime.timedelta(days=7)
+  sp = util.parse_object_id(params['sp']) if params.get('sp') else None
+  return since, until, sp
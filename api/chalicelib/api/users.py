@@ -1,5 +1,6 @@
 from bson.objectid import ObjectId
 from chalicelib.util import database, util, errors, mail
+from chalicelib.api import accounts
 
 def me(user):
   db = database.get_db()
@@ -42,4 +43,5 @@ def update(user, id, data):
   if 'lastName' in data: update['lastName'] = data['lastName']
   if update:
     db.users.update({'_id': ObjectId(id)}, {'$set': update})
+    accounts.invalidate_user(user['_id'])
   return get(user, id)
@@ -0,0 +1,42 @@
+import os
+from chalicelib.util import database
+
+try:
+  from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+  AsyncIOMotorClient = None
+
+db = None
+read_db = None
+pid = None
+
+def use(handle):
+  global db, read_db, pid
+  db = handle
+  read_db = handle.client.get_database(handle.name, read_preference=database.read_preference())
+  pid = os.getpid()
+
+def connect():
+  if AsyncIOMotorClient is None: raise RuntimeError('The ASGI app requires motor. Install it with: poetry install --extras asgi')
+  use(AsyncIOMotorClient(os.environ.get('MONGO_URL'), **database.client_options())[os.environ.get('MONGO_DATABASE')])
+
+def get_db():
+  if db is None or pid != os.getpid(): connect()
+  return db
+
+def get_read_db():
+  if db is None or pid != os.getpid(): connect()
+  return read_db
+
+async def warm_up():
+  try:
+    await get_db().command('ping')
+    await get_read_db().command('ping', read_preference=read_db.read_preference)
+  except Exception as e:
+    print(e)
+    print('Unable to warm up the database connection')
+
+def close():
+  global db, read_db, pid
+  if db is not None and pid == os.getpid(): db.client.close()
+  db, read_db, pid = None, None, None
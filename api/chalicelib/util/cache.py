@@ -0,0 +1,59 @@
+import threading, time
+from collections import OrderedDict
+
+class TTLCache:
+  def __init__(self, max_size=1024, ttl=60):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._groups = {}
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry and entry[0] > time.monotonic():
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+      if entry: self._remove(key)
+      self.misses += 1
+      return None
+
+  def set(self, key, value, group=None, ttl=None):
+    if self.max_size <= 0: return
+    ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+    if ttl <= 0: return
+    with self._lock:
+      if key in self._entries: self._remove(key)
+      self._entries[key] = (time.monotonic() + ttl, value, group)
+      if group is not None: self._groups.setdefault(group, set()).add(key)
+      while len(self._entries) > self.max_size:
+        self._remove(next(iter(self._entries)))
+
+  def invalidate(self, key):
+    with self._lock:
+      if key in self._entries: self._remove(key)
+
+  def invalidate_group(self, group):
+    with self._lock:
+      for key in list(self._groups.get(group, [])):
+        self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._groups.clear()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxSize': self.max_size}
+
+  def _remove(self, key):
+    _, _, group = self._entries.pop(key)
+    if group is not None:
+      keys = self._groups.get(group)
+      if keys is not None:
+        keys.discard(key)
+        if not keys: del self._groups[group]
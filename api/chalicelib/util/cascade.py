@@ -0,0 +1,71 @@
+import os, threading, datetime
+import pymongo
+from chalicelib.util import database
+
+child_collections = ['idpSps', 'idpUsers', 'idpAttributes', 'requests', 'oauthRequests', 'oauthSessions', 'idpStats']
+batch_size = int(os.environ.get('CASCADE_BATCH_SIZE', 5000))
+stale_after = datetime.timedelta(minutes=10)
+worker = {'thread': None}
+worker_lock = threading.Lock()
+
+def enqueue(idp_ids):
+  if not idp_ids: return None
+  db = database.get_db()
+  result = db.jobs.insert_one({
+    'type': 'cascadeDelete',
+    'status': 'pending',
+    'idps': list(idp_ids),
+    'remaining': list(child_collections),
+    'deleted': {},
+    'createdAt': datetime.datetime.utcnow()
+  })
+  start_worker()
+  return result.inserted_id
+
+def start_worker():
+  with worker_lock:
+    if worker['thread'] and worker['thread'].is_alive(): return
+    worker['thread'] = threading.Thread(target=run_pending, daemon=True)
+    worker['thread'].start()
+
+def claim_job():
+  db = database.get_db()
+  now = datetime.datetime.utcnow()
+  return db.jobs.find_one_and_update(
+    {'type': 'cascadeDelete', '$or': [{'status': 'pending'}, {'status': 'running', 'lockedAt': {'$lt': now - stale_after}}]},
+    {'$set': {'status': 'running', 'lockedAt': now}},
+    sort=[('createdAt', pymongo.ASCENDING)],
+    return_document=pymongo.ReturnDocument.AFTER
+  )
+
+def run_pending():
+  completed = 0
+  job = claim_job()
+  while job:
+    run_job(job)
+    completed += 1
+    job = claim_job()
+  return completed
+
+def run_job(job):
+  db = database.get_db()
+  for collection in list(job['remaining']):
+    while True:
+      ids = [doc['_id'] for doc in db[collection].find({'idp': {'$in': job['idps']}}, {'_id': 1}).limit(batch_size)]
+      if not ids: break
+      deleted = db[collection].delete_many({'_id': {'$in': ids}}).deleted_count
+      db.jobs.update_one({'_id': job['_id']}, {'$inc': {'deleted.' + collection: deleted}, '$set': {'lockedAt': datetime.datetime.utcnow()}})
+    db.jobs.update_one({'_id': job['_id']}, {'$pull': {'remaining': collection}})
+  db.jobs.update_one({'_id': job['_id']}, {'$set': {'status': 'done', 'completedAt': datetime.datetime.utcnow()}, '$unset': {'lockedAt': ''}})
+
+def sweep_orphans():
+  db = database.get_db()
+  referenced = set()
+  for collection in child_collections:
+    referenced.update(group['_id'] for group in db[collection].aggregate([{'$group': {'_id': '$idp'}}], allowDiskUse=True) if group['_id'])
+  existing = set()
+  candidates = list(referenced)
+  for i in range(0, len(candidates), batch_size):
+    existing.update(idp['_id'] for idp in db.idps.find({'_id': {'$in': candidates[i:i + batch_size]}}, {'_id': 1}))
+  orphans = list(referenced - existing)
+  return {'orphanedIdps': len(orphans), 'job': enqueue(orphans)}
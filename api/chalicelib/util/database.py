@@ -1,10 +1,62 @@
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
+
+read_preferences = {
+  'primary': ReadPreference.PRIMARY,
+  'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+  'secondary': ReadPreference.SECONDARY,
+  'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+  'nearest': ReadPreference.NEAREST,
+}
+
+def client_options():
+  return {
+    'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+    'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+    'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+    'socketTimeoutMS': int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+  }
+
+def read_preference():
+  name = os.environ.get('MONGO_READ_PREFERENCE', 'secondaryPreferred')
+  if name not in read_preferences: raise ValueError('MONGO_READ_PREFERENCE must be one of: ' + ', '.join(read_preferences))
+  return read_preferences[name]
 
 db = None
+read_db = None
+pid = None
+
+def use(handle):
+  # Both handles share one client, which belongs to the process that created it
+  global db, read_db, pid
+  db = handle
+  read_db = handle.client.get_database(handle.name, read_preference=read_preference())
+  pid = os.getpid()
+
+def connect():
+  # MongoClient is not fork-safe, so a process forked after the client was created (such as a preloaded gunicorn worker) opens its own
+  use(MongoClient(os.environ.get('MONGO_URL'), connect=False, **client_options())[os.environ.get('MONGO_DATABASE')])
 
 def get_db():
-  global db
-  if not db:
-    db = MongoClient(os.environ.get('MONGO_URL'))[os.environ.get('MONGO_DATABASE')]
+  if db is None or pid != os.getpid(): connect()
   return db
+
+def get_read_db():
+  # For heavy read-only queries (logs, stats and exports) that can tolerate replication lag. Accounts, sessions and IdP resources stay on the primary.
+  if db is None or pid != os.getpid(): connect()
+  return read_db
+
+def warm_up():
+  # Selects the servers and opens connections before the first request needs them
+  try:
+    get_db().command('ping')
+    get_read_db().command('ping', read_preference=read_db.read_preference)
+  except Exception as e:
+    print(e)
+    print('Unable to warm up the database connection')
+
+def close():
+  global db, read_db, pid
+  if db is not None and pid == os.getpid(): db.client.close()
+  db, read_db, pid = None, None, None
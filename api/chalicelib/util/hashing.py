@@ -0,0 +1,129 @@
+import os, math, threading, time, multiprocessing, bcrypt
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from chalicelib.util import errors, metrics
+
+workers = int(os.environ.get('HASH_WORKERS', 2))
+queue_limit = int(os.environ.get('HASH_QUEUE_LIMIT', 8))
+timeout = float(os.environ.get('HASH_TIMEOUT', 5))
+
+# bcrypt work factor per collection. IdP users are test accounts, so they get a cheaper hash.
+policies = {
+  'users': int(os.environ.get('HASH_ROUNDS_USERS', 12)),
+  'idpUsers': int(os.environ.get('HASH_ROUNDS_IDP_USERS', 8)),
+}
+seed_hashes = {}
+
+slots = threading.BoundedSemaphore(max(queue_limit, 1))
+pool = {'pid': None, 'executor': None}
+pool_lock = threading.Lock()
+counters = {'rejected': 0, 'timedOut': 0}
+metrics.collect('bcrypt_rejected_total', 'counter', lambda: counters['rejected'])
+metrics.collect('bcrypt_timed_out_total', 'counter', lambda: counters['timedOut'])
+metrics.collect('bcrypt_workers', 'gauge', lambda: workers)
+metrics.collect('bcrypt_queue_limit', 'gauge', lambda: queue_limit)
+
+def get_executor():
+  if pool['pid'] != os.getpid():
+    with pool_lock:
+      if pool['pid'] != os.getpid():
+        pool['executor'] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        pool['pid'] = os.getpid()
+  return pool['executor']
+
+def warm_up():
+  # The pool spawns its processes on first use, which takes a few hundred milliseconds, so workers start them before the first login
+  if workers <= 0: return
+  try:
+    for future in [get_executor().submit(time.sleep, 0.1) for _ in range(workers)]: future.result(timeout=30)
+  except Exception as e:
+    print(e)
+    print('Unable to start the hashing processes')
+
+def submit(fn, *args, wait=0):
+  # Each queued or running bcrypt call holds a slot until it finishes
+  if not (slots.acquire(timeout=wait) if wait else slots.acquire(blocking=False)):
+    counters['rejected'] += 1
+    raise errors.ServiceUnavailable('The server is busy. Please try again shortly.')
+  try:
+    future = get_executor().submit(fn, *args)
+  except Exception:
+    slots.release()
+    raise
+  future.add_done_callback(lambda f: slots.release())
+  return future
+
+def run(operation, fn, *args):
+  start = time.monotonic()
+  try:
+    if workers <= 0: return fn(*args)
+    future = submit(fn, *args)
+    try:
+      return future.result(timeout=timeout)
+    except TimeoutError:
+      counters['timedOut'] += 1
+      future.cancel()
+      raise errors.ServiceUnavailable('The server is busy. Please try again shortly.')
+    except BrokenProcessPool:
+      pool['pid'] = None
+      raise errors.ServiceUnavailable('The server is busy. Please try again shortly.')
+  finally:
+    metrics.record('bcrypt_' + operation, time.monotonic() - start)
+
+def hashpw(password, salt=None):
+  return run('hashpw', bcrypt.hashpw, password, salt or bcrypt.gensalt())
+
+def checkpw(password, hashed):
+  return run('checkpw', bcrypt.checkpw, password, hashed)
+
+def hash_password(password, collection, seed=False):
+  rounds = policies[collection]
+  if seed:
+    if (password, rounds) not in seed_hashes:
+      seed_hashes[(password, rounds)] = hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+    return seed_hashes[(password, rounds)]
+  return hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+
+def hash_passwords(passwords, collection):
+  rounds = policies[collection]
+  arguments = [(password.encode('utf-8'), bcrypt.gensalt(rounds)) for password in passwords]
+  start = time.monotonic()
+  try:
+    if workers <= 0: return [bcrypt.hashpw(*a) for a in arguments]
+    # A batch waits for slots instead of being rejected, but holds at most half of them, so logins still get through during an import
+    window = max(queue_limit // 2, 1)
+    hashes = []
+    for offset in range(0, len(arguments), window):
+      futures = []
+      try:
+        for a in arguments[offset:offset + window]: futures.append(submit(bcrypt.hashpw, *a, wait=timeout))
+        deadline = time.monotonic() + timeout * math.ceil(len(futures) / workers)
+        hashes += [future.result(timeout=max(deadline - time.monotonic(), 0)) for future in futures]
+      except TimeoutError:
+        counters['timedOut'] += 1
+        raise errors.ServiceUnavailable('The server is busy. Please try again shortly.')
+      except BrokenProcessPool:
+        pool['pid'] = None
+        raise errors.ServiceUnavailable('The server is busy. Please try again shortly.')
+      finally:
+        for future in futures: future.cancel()
+    return hashes
+  finally:
+    metrics.record('bcrypt_hashpw_batch', time.monotonic() - start)
+
+def needs_rehash(hashed, collection):
+  try:
+    _, prefix, rounds, _ = hashed.split(b'$', 3)
+    return prefix != b'2b' or int(rounds) != policies[collection]
+  except ValueError:
+    return True
+
+def stats():
+  return {
+    'workers': workers,
+    'queueLimit': queue_limit,
+    'rejected': counters['rejected'],
+    'timedOut': counters['timedOut'],
+    'hashpw': metrics.histogram('bcrypt_hashpw_seconds').snapshot(),
+    'checkpw': metrics.histogram('bcrypt_checkpw_seconds').snapshot(),
+  }
@@ -0,0 +1,169 @@
+import os
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from bson.objectid import ObjectId
+from chalicelib.util import database
+
+log_retention_days = int(os.environ.get('LOG_RETENTION_DAYS', 0))
+
+declared = {
+  'users': [
+    IndexModel([('email', ASCENDING)], name='email_1'),
+    IndexModel([('lastSeenAt', DESCENDING)], name='lastSeenAt_-1'),
+  ],
+  'sessions': [
+    IndexModel([('expiresAt', ASCENDING)], name='expiresAt_1', expireAfterSeconds=0),
+    IndexModel([('user', ASCENDING)], name='user_1'),
+  ],
+  'idps': [
+    IndexModel([('code', ASCENDING)], name='code_1'),
+    IndexModel([('user', ASCENDING)], name='user_1'),
+  ],
+  'idpSps': [
+    IndexModel([('idp', ASCENDING), ('entityId', ASCENDING)], name='idp_1_entityId_1'),
+    IndexModel([('idp', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)], name='idp_1_name_1__id_1'),
+    IndexModel([('oauth2ClientId', ASCENDING)], name='oauth2ClientId_1'),
+  ],
+  'idpUsers': [
+    IndexModel([('idp', ASCENDING), ('email', ASCENDING), ('_id', ASCENDING)], name='idp_1_email_1__id_1'),
+    IndexModel([('idp', ASCENDING), ('firstName', ASCENDING), ('_id', ASCENDING)], name='idp_1_firstName_1__id_1'),
+    IndexModel([('idp', ASCENDING), ('lastName', ASCENDING), ('_id', ASCENDING)], name='idp_1_lastName_1__id_1'),
+    IndexModel([('idp', ASCENDING), ('searchKeys', ASCENDING)], name='idp_1_searchKeys_1'),
+  ],
+  'idpAttributes': [
+    IndexModel([('idp', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)], name='idp_1_name_1__id_1'),
+  ],
+  'requests': [
+    IndexModel([('idp', ASCENDING), ('createdAt', DESCENDING), ('_id', DESCENDING)], name='idp_1_createdAt_-1__id_-1'),
+    IndexModel([('data.id', ASCENDING)], name='data.id_1'),
+  ],
+  'oauthRequests': [
+    IndexModel([('idp', ASCENDING), ('createdAt', DESCENDING), ('_id', DESCENDING)], name='idp_1_createdAt_-1__id_-1'),
+  ],
+  'idpStats': [
+    IndexModel([('idp', ASCENDING), ('hour', ASCENDING), ('kind', ASCENDING), ('sp', ASCENDING)], name='idp_1_hour_1_kind_1_sp_1', unique=True),
+  ],
+  'mailOutbox': [
+    IndexModel([('status', ASCENDING), ('nextAttemptAt', ASCENDING)], name='status_1_nextAttemptAt_1'),
+    IndexModel([('deliveredAt', ASCENDING)], name='deliveredAt_1', expireAfterSeconds=7 * 24 * 60 * 60),
+  ],
+  'rateLimits': [
+    IndexModel([('expireAt', ASCENDING)], name='expireAt_1', expireAfterSeconds=0),
+  ],
+  'jobs': [
+    IndexModel([('type', ASCENDING), ('status', ASCENDING), ('createdAt', ASCENDING)], name='type_1_status_1_createdAt_1'),
+    # Finished jobs are kept for a week for inspection. Pending and running jobs have no completedAt, so they never expire.
+    IndexModel([('completedAt', ASCENDING)], name='completedAt_1', expireAfterSeconds=7 * 24 * 60 * 60),
+  ],
+  'keyPool': [
+    IndexModel([('keySize', ASCENDING)], name='keySize_1'),
+  ],
+  'oauthSessions': [
+    IndexModel([('idp', ASCENDING), ('code', ASCENDING)], name='idp_1_code_1'),
+    IndexModel([('idp', ASCENDING), ('accessToken', ASCENDING)], name='idp_1_accessToken_1'),
+  ],
+}
+
+if log_retention_days:
+  for collection in ('requests', 'oauthRequests'):
+    declared[collection].append(IndexModel([('createdAt', ASCENDING)], name='createdAt_1', expireAfterSeconds=log_retention_days * 24 * 60 * 60))
+
+# Representative filters and sorts for the queries issued by chalicelib.api
+sample_id = ObjectId()
+query_shapes = [
+  ('users', {'email': 'joe@example.com'}, None),
+  ('users', {'_id': {'$ne': sample_id}, 'email': 'joe@example.com'}, None),
+  ('users', {'_id': sample_id, 'tokens.enrolment': 'token'}, None),
+  ('users', {'_id': sample_id, 'tokens.passwordReset': 'token'}, None),
+  ('sessions', {'_id': 'hash', 'user': sample_id}, None),
+  ('sessions', {'user': sample_id}, None),
+  ('users', {'lastSeenAt': {'$gte': sample_id.generation_time}}, [('lastSeenAt', DESCENDING)]),
+  ('sessions', {'user': {'$in': [sample_id]}, 'expiresAt': {'$gt': sample_id.generation_time}}, [('createdAt', DESCENDING)]),
+  ('idps', {'_id': sample_id}, None),
+  ('idps', {'code': 'code'}, None),
+  ('idps', {'code': 'code', '_id': {'$ne': sample_id}}, None),
+  ('idps', {'user': sample_id}, None),
+  ('idps', {'_id': {'$in': [sample_id]}, 'user': {'$exists': False}}, None),
+  ('idps', {'$or': [{'user': sample_id}, {'_id': {'$in': [sample_id]}, 'user': {'$exists': False}}]}, None),
+  ('idpSps', {'_id': sample_id}, None),
+  ('idpSps', {'idp': sample_id}, None),
+  ('idpUsers', {'_id': sample_id}, None),
+  ('idpUsers', {'idp': sample_id}, None),
+  ('idpAttributes', {'_id': sample_id}, None),
+  ('idpAttributes', {'idp': sample_id}, None),
+  ('idpUsers', {'idp': sample_id}, [('email', ASCENDING), ('_id', ASCENDING)]),
+  ('idpUsers', {'$and': [{'idp': sample_id}, {'$or': [{'lastName': {'$gt': 'Doe'}}, {'lastName': 'Doe', '_id': {'$gt': sample_id}}]}]}, [('lastName', ASCENDING), ('_id', ASCENDING)]),
+  ('idpUsers', {'idp': sample_id, 'searchKeys': {'$regex': '^jo'}}, [('email', ASCENDING), ('_id', ASCENDING)]),
+  ('idpSps', {'idp': sample_id}, [('name', ASCENDING), ('_id', ASCENDING)]),
+  ('idpAttributes', {'idp': sample_id}, [('name', ASCENDING), ('_id', ASCENDING)]),
+  ('requests', {'idp': sample_id}, [('createdAt', DESCENDING), ('_id', DESCENDING)]),
+  ('requests', {'$and': [{'idp': sample_id, 'sp': sample_id}, {'$or': [{'createdAt': {'$lt': sample_id.generation_time}}, {'createdAt': sample_id.generation_time, '_id': {'$lt': sample_id}}]}]}, [('createdAt', DESCENDING), ('_id', DESCENDING)]),
+  ('requests', {'$and': [{'idp': sample_id}, {'$or': [{'createdAt': {'$gt': sample_id.generation_time}}, {'createdAt': sample_id.generation_time, '_id': {'$gt': sample_id}}]}]}, [('createdAt', ASCENDING), ('_id', ASCENDING)]),
+  ('oauthRequests', {'idp': sample_id}, [('createdAt', DESCENDING), ('_id', DESCENDING)]),
+  ('jobs', {'type': 'cascadeDelete', '$or': [{'status': 'pending'}, {'status': 'running', 'lockedAt': {'$lt': sample_id.generation_time}}]}, [('createdAt', ASCENDING)]),
+  ('mailOutbox', {'status': 'pending'}, [('nextAttemptAt', ASCENDING)]),
+  ('mailOutbox', {'$or': [{'status': 'pending', 'nextAttemptAt': {'$lte': sample_id.generation_time}}, {'status': 'sending', 'lockedAt': {'$lt': sample_id.generation_time}}]}, [('nextAttemptAt', ASCENDING)]),
+  ('idpStats', {'idp': sample_id, 'hour': {'$gte': sample_id.generation_time, '$lt': sample_id.generation_time}}, [('hour', ASCENDING)]),
+  ('oauthRequests', {'idp': sample_id, 'createdAt': {'$gte': sample_id.generation_time}}, [('createdAt', ASCENDING), ('_id', ASCENDING)]),
+]
+
+def index_spec(document):
+  options = {key: value for key, value in document.items() if key not in ('key', 'name', 'v', 'ns', 'background')}
+  key = document['key'].items() if hasattr(document['key'], 'items') else document['key']
+  return dict(options, key=[(field, int(direction)) for field, direction in key])
+
+def ensure_indexes(db=None):
+  db = db if db is not None else database.get_db()
+  changes = []
+  for collection, models in declared.items():
+    existing = db[collection].index_information()
+    for model in models:
+      wanted = index_spec(model.document)
+      name = model.document['name']
+      if name not in existing:
+        changes.append('{0}.{1}: created'.format(collection, name))
+        continue
+      current = index_spec(existing[name])
+      if current == wanted: continue
+      if dict(current, expireAfterSeconds=None) == dict(wanted, expireAfterSeconds=None) and 'expireAfterSeconds' in wanted:
+        db.command('collMod', collection, index={'name': name, 'expireAfterSeconds': wanted['expireAfterSeconds']})
+        changes.append('{0}.{1}: updated expireAfterSeconds'.format(collection, name))
+      else:
+        db[collection].drop_index(name)
+        changes.append('{0}.{1}: recreated'.format(collection, name))
+    db[collection].create_indexes(models)
+  return changes
+
+def drift_report(db=None):
+  db = db if db is not None else database.get_db()
+  report = {}
+  for collection, models in declared.items():
+    existing = db[collection].index_information()
+    existing.pop('_id_', None)
+    wanted = {model.document['name']: model.document for model in models}
+    entry = {
+      'missing': [name for name in wanted if name not in existing],
+      'changed': [name for name in wanted if name in existing and index_spec(existing[name]) != index_spec(wanted[name])],
+      'extra': [name for name in existing if name not in wanted],
+    }
+    if any(entry.values()): report[collection] = entry
+  return report
+
+def plan_stages(plan):
+  stages = [plan.get('stage')]
+  for key in ('inputStage', 'queryPlan'):
+    if key in plan: stages += plan_stages(plan[key])
+  for child in plan.get('inputStages', []):
+    stages += plan_stages(child)
+  return stages
+
+def check_query_plans(db=None):
+  db = db if db is not None else database.get_db()
+  failures = []
+  for collection, query, sort in query_shapes:
+    cursor = db[collection].find(query)
+    if sort: cursor = cursor.sort(sort)
+    explained = cursor.explain()
+    winning_plan = explained['queryPlanner']['winningPlan']
+    if 'COLLSCAN' in plan_stages(winning_plan):
+      failures.append({'collection': collection, 'query': query, 'sort': sort, 'plan': winning_plan})
+  return failures
@@ -0,0 +1,105 @@
+import os, threading, time, datetime, uuid
+from pymongo.errors import DuplicateKeyError
+from chalicelib.util import database
+
+# pyOpenSSL is only needed to create IdPs, so it is imported on first use to keep worker startup fast
+
+key_size = int(os.environ.get('IDP_KEY_SIZE', 1024))
+pool_size = int(os.environ.get('KEY_POOL_SIZE', 20))
+low_water_mark = int(os.environ.get('KEY_POOL_LOW_WATER_MARK', 5))
+background_refill = os.environ.get('KEY_POOL_BACKGROUND_REFILL', 'true').lower() == 'true'
+# Claims don't count the pool. Every this many claims, a background thread checks whether it needs a refill.
+check_interval = max(int(os.environ.get('KEY_POOL_CHECK_INTERVAL', 5)), 1)
+# Only the worker holding the refill lease in jobState generates keys, so workers don't overfill the pool together
+lease_seconds = int(os.environ.get('KEY_POOL_LEASE', 60))
+host_id = uuid.uuid4().hex
+
+counters = {'claimed': 0, 'fallbacks': 0, 'generated': 0, 'generationSeconds': 0.0}
+refill_lock = threading.Lock()
+
+def generate_key():
+  from OpenSSL import crypto
+  start = time.monotonic()
+  k = crypto.PKey()
+  k.generate_key(crypto.TYPE_RSA, key_size)
+  counters['generated'] += 1
+  counters['generationSeconds'] += time.monotonic() - start
+  return k
+
+def depth():
+  db = database.get_db()
+  return db.keyPool.count_documents({'keySize': key_size})
+
+def lease_owner():
+  # Forked workers share host_id, so the pid tells them apart
+  return '{0}:{1}'.format(host_id, os.getpid())
+
+def take_lease(db):
+  # Takes or renews the lease. The upsert fails on the unique _id while another worker's lease is current.
+  now = datetime.datetime.utcnow()
+  try:
+    db.jobState.update_one({'_id': 'keyPool.refill', '$or': [{'owner': lease_owner()}, {'leaseUntil': {'$lt': now}}]}, {'$set': {'owner': lease_owner(), 'leaseUntil': now + datetime.timedelta(seconds=lease_seconds)}}, upsert=True)
+    return True
+  except DuplicateKeyError:
+    return False
+
+def release_lease(db):
+  db.jobState.update_one({'_id': 'keyPool.refill', 'owner': lease_owner()}, {'$set': {'leaseUntil': datetime.datetime.utcnow()}})
+
+def refill(limit=None):
+  if not refill_lock.acquire(blocking=False): return 0
+  from OpenSSL import crypto
+  try:
+    db = database.get_db()
+    if not take_lease(db): return 0
+    try:
+      missing = pool_size - depth()
+      if limit is not None: missing = min(missing, limit)
+      generated = 0
+      # The lease is renewed after each key, and the refill stops if another worker took it over
+      while generated < missing:
+        k = generate_key()
+        db.keyPool.insert_one({
+          'keySize': key_size,
+          'key': crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode('utf-8'),
+          'createdAt': datetime.datetime.utcnow()
+        })
+        generated += 1
+        if not take_lease(db): break
+      return generated
+    finally:
+      release_lease(db)
+  finally:
+    refill_lock.release()
+
+def top_up():
+  if depth() < low_water_mark: refill()
+
+def refill_in_background(check=True):
+  # check runs the depth check in the thread first, and is left out when the pool is known to be empty
+  if not background_refill or refill_lock.locked(): return
+  threading.Thread(target=top_up if check else refill, daemon=True).start()
+
+def claim():
+  db = database.get_db()
+  claimed = db.keyPool.find_one_and_delete({'keySize': key_size}, sort=[('_id', 1)])
+  if claimed:
+    from OpenSSL import crypto
+    counters['claimed'] += 1
+    if counters['claimed'] % check_interval == 0: refill_in_background()
+    return crypto.load_privatekey(crypto.FILETYPE_PEM, claimed['key'])
+  counters['fallbacks'] += 1
+  refill_in_background(check=False)
+  return None
+
+def stats():
+  return {
+    'keySize': key_size,
+    'depth': depth(),
+    'poolSize': pool_size,
+    'lowWaterMark': low_water_mark,
+    'claimed': counters['claimed'],
+    'fallbacks': counters['fallbacks'],
+    'generated': counters['generated'],
+    'refillRate': counters['generated'] / counters['generationSeconds'] if counters['generationSeconds'] else None,
+  }
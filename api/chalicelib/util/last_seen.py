@@ -0,0 +1,86 @@
+import os, atexit, threading, datetime, time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from chalicelib.util import database, metrics
+
+resolution = int(os.environ.get('LAST_SEEN_RESOLUTION', 60))
+flush_interval = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 15))
+max_pending = int(os.environ.get('LAST_SEEN_MAX_PENDING', 500))
+
+pending = {}
+recorded = {}
+counters = {'touches': 0, 'writes': 0, 'flushes': 0, 'failedFlushes': 0}
+lock = threading.Lock()
+flusher = {'pid': None}
+# After a failed flush, requests leave retries to the flusher thread for one interval rather than writing inline
+retry = {'after': 0}
+
+def touch(user_id, last_seen_at=None):
+  now = datetime.datetime.now()
+  with lock:
+    counters['touches'] += 1
+    previous = recorded.get(user_id) or last_seen_at
+    if previous and (now - previous).total_seconds() < resolution: return
+    pending[user_id] = now
+    recorded[user_id] = now
+    full = len(pending) >= max_pending and time.monotonic() >= retry['after']
+  if full: flush()
+  else: start_flusher()
+
+def flush():
+  with lock:
+    if not pending: return 0
+    batch = dict(pending)
+    pending.clear()
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=resolution)
+    for user_id in [u for u, seen in recorded.items() if seen < cutoff]: del recorded[user_id]
+  items = list(batch.items())
+  failed = []
+  try:
+    database.get_db().users.bulk_write([UpdateOne({'_id': user_id}, {'$max': {'lastSeenAt': seen}}) for user_id, seen in items], ordered=False)
+  except BulkWriteError as e:
+    failed = [items[error['index']] for error in e.details['writeErrors']]
+  except Exception as e:
+    print(e)
+    failed = items
+  with lock:
+    # Failed updates go back into the buffer, unless a newer one for the same user was queued meanwhile
+    for user_id, seen in failed:
+      if pending.get(user_id, seen) <= seen: pending[user_id] = seen
+    counters['writes'] += len(items) - len(failed)
+    counters['flushes'] += 1
+    if failed:
+      counters['failedFlushes'] += 1
+      retry['after'] = time.monotonic() + flush_interval
+  if failed: print('Unable to flush {0} lastSeenAt updates, they will be retried'.format(len(failed)))
+  return len(items) - len(failed)
+
+def start_flusher():
+  if flusher['pid'] == os.getpid(): return
+  with lock:
+    if flusher['pid'] == os.getpid(): return
+    flusher['pid'] = os.getpid()
+  threading.Thread(target=run_flusher, daemon=True).start()
+
+def run_flusher():
+  while True:
+    time.sleep(flush_interval)
+    flush()
+
+def stats():
+  return {
+    'touches': counters['touches'],
+    'writes': counters['writes'],
+    'savedWrites': counters['touches'] - counters['writes'] - len(pending),
+    'flushes': counters['flushes'],
+    'failedFlushes': counters['failedFlushes'],
+    'pending': len(pending),
+  }
+
+metrics.collect('last_seen_touches_total', 'counter', lambda: counters['touches'])
+metrics.collect('last_seen_writes_total', 'counter', lambda: counters['writes'])
+metrics.collect('last_seen_saved_writes_total', 'counter', lambda: stats()['savedWrites'])
+metrics.collect('last_seen_flushes_total', 'counter', lambda: counters['flushes'])
+metrics.collect('last_seen_failed_flushes_total', 'counter', lambda: counters['failedFlushes'])
+metrics.collect('last_seen_pending', 'gauge', lambda: len(pending))
+atexit.register(flush)
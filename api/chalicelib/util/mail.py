@@ -1,6 +1,23 @@
-import os
-import requests
+import os, json, threading, datetime
+from email.utils import parseaddr
+import pymongo
+from chalicelib.util import database, metrics
 
+batch_size = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+max_attempts = int(os.environ.get('MAIL_MAX_ATTEMPTS', 6))
+retry_delay = int(os.environ.get('MAIL_RETRY_DELAY', 30))
+timeout = (float(os.environ.get('MAIL_CONNECT_TIMEOUT', 3)), float(os.environ.get('MAIL_READ_TIMEOUT', 10)))
+background_delivery = os.environ.get('MAIL_BACKGROUND_DELIVERY', 'true').lower() == 'true'
+poll_interval = int(os.environ.get('MAIL_POLL_INTERVAL', 60))
+stale_after = datetime.timedelta(minutes=5)
+
+session = {'session': None}
+session_lock = threading.Lock()
+worker = {'pid': None}
+worker_lock = threading.Lock()
+wake = threading.Event()
+
+@metrics.timed('mail_send')
 def send(data):
   if 'from' not in data:
     data['from'] = 'SSO Tools <no_reply@mail.sso.tools>'
@@ -10,18 +27,103 @@ def send(data):
     del data['to_user']
   data['text'] += '\n\nFrom the team at SSO Tools\n\n\n\n--\n\nReceived this email in error? Please let us know by contacting hello@sso.tools'
 
+  db = database.get_db()
+  now = datetime.datetime.utcnow()
+  db.mailOutbox.insert_one({'data': data, 'status': 'pending', 'attempts': 0, 'nextAttemptAt': now, 'createdAt': now})
+  if background_delivery:
+    start_worker()
+    wake.set()
+
+def get_session():
+  # requests is only imported once there is mail to deliver, to keep worker startup fast
+  with session_lock:
+    if session['session'] is None:
+      import requests
+      session['session'] = requests.Session()
+      session['session'].mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return session['session']
+
+def start_worker():
+  # One delivery thread per process. Threads don't survive a fork, so a preloaded gunicorn worker starts its own.
+  if worker['pid'] == os.getpid(): return
+  with worker_lock:
+    if worker['pid'] == os.getpid(): return
+    worker['pid'] = os.getpid()
+  threading.Thread(target=run_worker, daemon=True).start()
+
+def claim_messages():
+  db = database.get_db()
+  now = datetime.datetime.utcnow()
+  messages = []
+  while len(messages) < batch_size:
+    message = db.mailOutbox.find_one_and_update(
+      {'$or': [{'status': 'pending', 'nextAttemptAt': {'$lte': now}}, {'status': 'sending', 'lockedAt': {'$lt': now - stale_after}}]},
+      {'$set': {'status': 'sending', 'lockedAt': now}},
+      sort=[('nextAttemptAt', pymongo.ASCENDING)],
+      return_document=pymongo.ReturnDocument.AFTER
+    )
+    if not message: break
+    messages.append(message)
+  return messages
+
+def deliver_pending():
+  delivered = 0
+  messages = claim_messages()
+  while messages:
+    # Messages with the same content go out as one batch request, with recipient variables so each recipient only sees themselves
+    groups = {}
+    for message in messages:
+      data = message['data']
+      groups.setdefault((data.get('from'), data.get('subject'), data.get('text')), []).append(message)
+    for group in groups.values():
+      delivered += deliver(group)
+    messages = claim_messages()
+  return delivered
+
+def deliver(messages):
+  db = database.get_db()
+  ids = [message['_id'] for message in messages]
+  data = dict(messages[0]['data'])
+  if len(messages) > 1:
+    data['to'] = [message['data']['to'] for message in messages]
+    data['recipient-variables'] = json.dumps({parseaddr(recipient)[1]: {} for recipient in data['to']})
+
   base_url = os.environ.get('MAILGUN_URL')
   api_key = os.environ.get('MAILGUN_KEY')
-  if base_url and api_key:
-    auth = ('api', api_key)
-    try:
-      response = requests.post(base_url, auth=auth, data=data)
+  try:
+    if base_url and api_key:
+      response = get_session().post(base_url, auth=('api', api_key), data=data, timeout=timeout)
       response.raise_for_status()
-    except Exception as e:
-      print(e)
-      print('Unable to send email')
-  else:
-    print('Not sending email. Message pasted below.')
-    print(data)
+    else:
+      print('Not sending email. Message pasted below.')
+      print(data)
+  except Exception as e:
+    print(e)
+    print('Unable to send email')
+    for message in messages:
+      attempts = message['attempts'] + 1
+      update = {'status': 'failed' if attempts >= max_attempts else 'pending', 'attempts': attempts, 'lastError': str(e)}
+      update['nextAttemptAt'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_delay * 2 ** message['attempts'])
+      db.mailOutbox.update_one({'_id': message['_id']}, {'$set': update, '$unset': {'lockedAt': ''}})
+    return 0
+  db.mailOutbox.update_many({'_id': {'$in': ids}}, {'$set': {'status': 'sent', 'deliveredAt': datetime.datetime.utcnow()}, '$inc': {'attempts': 1}, '$unset': {'lockedAt': ''}})
+  return len(messages)
 
+def next_attempt_in():
+  # Sleeps until the earliest retry is due, but wakes at least every poll_interval for mail queued by other processes and for stale claims
+  message = database.get_db().mailOutbox.find_one({'status': 'pending'}, {'nextAttemptAt': 1}, sort=[('nextAttemptAt', pymongo.ASCENDING)])
+  if not message: return poll_interval
+  return min(max((message['nextAttemptAt'] - datetime.datetime.utcnow()).total_seconds(), 0), poll_interval)
 
+def run_worker():
+  while True:
+    try:
+      deliver_pending()
+      wait = next_attempt_in()
+    except Exception as e:
+      print(e)
+      print('Unable to deliver queued mail')
+      wait = poll_interval
+    # send() wakes the worker early when it queues a message in this process
+    wake.wait(wait)
+    wake.clear()
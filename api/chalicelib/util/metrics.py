@@ -0,0 +1,234 @@
+import os, re, json, threading, time, functools, contextlib
+from flask import g, request, has_request_context
+from pymongo import monitoring
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+count_buckets = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+namespace = 'ssotools'
+server_timing = os.environ.get('METRICS_SERVER_TIMING', 'false').lower() == 'true'
+# When set, each process writes its series to a file in this directory, and /metrics adds up the files of all the processes
+metrics_dir = os.environ.get('METRICS_DIR')
+write_interval = float(os.environ.get('METRICS_WRITE_INTERVAL', 5))
+writer = {'pid': None}
+writer_lock = threading.Lock()
+
+class Histogram:
+  def __init__(self, buckets=default_buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.count = 0
+    self.sum = 0.0
+    self._lock = threading.Lock()
+
+  def observe(self, value):
+    with self._lock:
+      self.count += 1
+      self.sum += value
+      for i, bound in enumerate(self.buckets):
+        if value <= bound: self.counts[i] += 1
+
+  def snapshot(self):
+    with self._lock:
+      return {'buckets': dict(zip(self.buckets, self.counts)), 'count': self.count, 'sum': self.sum}
+
+class Counter:
+  def __init__(self):
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount=1):
+    with self._lock: self.value += amount
+
+histograms = {}
+counters = {}
+collected = {}
+registry_lock = threading.Lock()
+
+def get_or_create(registry, key, factory):
+  if key not in registry:
+    with registry_lock:
+      if key not in registry: registry[key] = factory()
+  return registry[key]
+
+def histogram(name, buckets=default_buckets, labels=None):
+  return get_or_create(histograms, (name, tuple(sorted((labels or {}).items()))), lambda: Histogram(buckets))
+
+def counter(name, labels=None):
+  return get_or_create(counters, (name, tuple(sorted((labels or {}).items()))), Counter)
+
+def collect(name, kind, read, labels=None):
+  # For values other modules already keep, such as cache and queue counters. read is called each time /metrics is rendered.
+  collected[(name, tuple(sorted((labels or {}).items())))] = (kind, read)
+
+def collect_cache(name, cache):
+  labels = {'cache': name}
+  collect('cache_hits_total', 'counter', lambda: cache.hits, labels)
+  collect('cache_misses_total', 'counter', lambda: cache.misses, labels)
+  collect('cache_entries', 'gauge', lambda: cache.stats()['size'], labels)
+
+def record(name, seconds, labels=None):
+  histogram(name + '_seconds', labels=labels).observe(seconds)
+  # Also attributed to the current request for the Server-Timing header
+  if has_request_context() and 'timings' in g: g.timings[name] = g.timings.get(name, 0) + seconds
+
+@contextlib.contextmanager
+def timer(name, labels=None):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record(name, time.perf_counter() - start, labels)
+
+def timed(name):
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with timer(name): return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+class MongoCommandListener(monitoring.CommandListener):
+  # pymongo calls listeners on the thread that ran the command, so commands can be attributed to the current request
+  def started(self, event): pass
+
+  def succeeded(self, event):
+    self.finished(event)
+
+  def failed(self, event):
+    self.finished(event)
+    counter('mongo_command_failures_total', {'command': event.command_name}).inc()
+
+  def finished(self, event):
+    seconds = event.duration_micros / 1000000
+    histogram('mongo_command_seconds', labels={'command': event.command_name}).observe(seconds)
+    if has_request_context() and 'mongo_commands' in g:
+      g.mongo_commands += 1
+      g.mongo_seconds += seconds
+
+monitoring.register(MongoCommandListener())
+
+def init_app(app):
+  @app.before_request
+  def start_request():
+    g.request_start = time.perf_counter()
+    g.mongo_commands = 0
+    g.mongo_seconds = 0.0
+    g.timings = {}
+
+  @app.after_request
+  def finish_request(response):
+    if 'request_start' not in g: return response
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {'route': route, 'method': request.method}
+    histogram('http_request_duration_seconds', labels=labels).observe(elapsed)
+    histogram('http_request_mongo_commands', count_buckets, labels).observe(g.mongo_commands)
+    histogram('http_request_mongo_seconds', labels=labels).observe(g.mongo_seconds)
+    counter('http_requests_total', dict(labels, status=str(response.status_code))).inc()
+    if server_timing:
+      timings = ['app;dur={0:.1f}'.format(elapsed * 1000), 'mongo;dur={0:.1f};desc="{1} commands"'.format(g.mongo_seconds * 1000, g.mongo_commands)]
+      timings += ['{0};dur={1:.1f}'.format(name, seconds * 1000) for name, seconds in g.timings.items()]
+      response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+def format_labels(labels):
+  if not labels: return ''
+  escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join('{0}="{1}"'.format(key, escape(value)) for key, value in labels) + '}'
+
+def snapshot():
+  # This process's series by (name, labels), as (kind, value). A histogram's value is its bucket counts, count and sum.
+  series = {}
+  for key, h in list(histograms.items()):
+    values = h.snapshot()
+    series[key] = ('histogram', [list(values['buckets'].items()), values['count'], values['sum']])
+  for key, c in list(counters.items()): series[key] = ('counter', c.value)
+  for key, (kind, read) in list(collected.items()): series[key] = (kind, read())
+  return series
+
+def file_path(pid):
+  return os.path.join(metrics_dir, 'metrics-{0}.json'.format(pid))
+
+def write():
+  # Replaced in one rename, so readers never see a partly written file
+  path = file_path(os.getpid())
+  with open(path + '.tmp', 'w') as f:
+    json.dump([[name, labels, kind, value] for (name, labels), (kind, value) in snapshot().items()], f)
+  os.replace(path + '.tmp', path)
+
+def run_writer():
+  while True:
+    time.sleep(write_interval)
+    try:
+      write()
+    except Exception as e:
+      print(e)
+      print('Unable to write the metrics file')
+
+def start_writer():
+  # One writer thread per process, started like mail.start_worker. A forked worker starts from empty histograms and counters, so what the master recorded while preloading isn't counted once per worker.
+  if not metrics_dir or writer['pid'] == os.getpid(): return
+  with writer_lock:
+    if writer['pid'] == os.getpid(): return
+    writer['pid'] = os.getpid()
+    histograms.clear()
+    counters.clear()
+  threading.Thread(target=run_writer, daemon=True).start()
+
+def clear():
+  # Called by the gunicorn master before it starts workers, so totals start again from zero like a single process's
+  if not metrics_dir: return
+  for filename in os.listdir(metrics_dir):
+    if filename.startswith('metrics-'): os.remove(os.path.join(metrics_dir, filename))
+
+def alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+def merge(total, series, live):
+  # Counters and histograms of exited workers still count towards the totals, so they never go down. Gauges only come from live workers.
+  for key, (kind, value) in series.items():
+    if kind == 'gauge' and not live: continue
+    if key not in total: total[key] = (kind, value)
+    elif kind == 'histogram':
+      buckets, count, seconds = total[key][1]
+      total[key] = (kind, [[[bound, n + other] for (bound, n), (_, other) in zip(buckets, value[0])], count + value[1], seconds + value[2]])
+    else: total[key] = (kind, total[key][1] + value)
+
+def gather():
+  if not metrics_dir: return snapshot()
+  write()
+  total = {}
+  for filename in os.listdir(metrics_dir):
+    match = re.fullmatch(r'metrics-(\d+)\.json', filename)
+    if not match: continue
+    try:
+      with open(os.path.join(metrics_dir, filename)) as f: series = json.load(f)
+    except (OSError, ValueError):
+      continue
+    merge(total, {(name, tuple(map(tuple, labels))): (kind, value) for name, labels, kind, value in series}, alive(int(match.group(1))))
+  return total
+
+def render():
+  series = gather()
+  lines = []
+  for name in sorted(set(name for name, _ in series)):
+    entries = sorted(((labels, value) for (series_name, labels), value in series.items() if series_name == name), key=lambda entry: entry[0])
+    kind = entries[0][1][0]
+    lines.append('# TYPE {0}_{1} {2}'.format(namespace, name, kind))
+    for labels, (_, value) in entries:
+      if kind != 'histogram':
+        lines.append('{0}_{1}{2} {3}'.format(namespace, name, format_labels(labels), value))
+        continue
+      buckets, count, seconds = value
+      for bound, n in buckets:
+        lines.append('{0}_{1}_bucket{2} {3}'.format(namespace, name, format_labels(labels + (('le', bound),)), n))
+      lines.append('{0}_{1}_bucket{2} {3}'.format(namespace, name, format_labels(labels + (('le', '+Inf'),)), count))
+      lines.append('{0}_{1}_sum{2} {3}'.format(namespace, name, format_labels(labels), seconds))
+      lines.append('{0}_{1}_count{2} {3}'.format(namespace, name, format_labels(labels), count))
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,26 @@
+import datetime
+from chalicelib.util import database, indexes, sessions
+from chalicelib.api import idps
+
+# Applied in order, once per database. Never rename or reorder entries that have shipped.
+registry = [
+  ('0001-sessions-collection', sessions.migrate_login_tokens),
+  ('0002-idp-child-counts', idps.migrate_child_counts),
+  ('0003-idp-user-search-keys', idps.migrate_user_search_keys),
+]
+
+def pending(db=None):
+  db = db if db is not None else database.get_db()
+  applied = set(m['_id'] for m in db.migrations.find({}, {'_id': 1}))
+  return [name for name, _ in registry if name not in applied]
+
+def run(db=None):
+  db = db if db is not None else database.get_db()
+  results = {'indexes': indexes.ensure_indexes(db), 'migrations': {}}
+  to_run = pending(db)
+  for name, migration in registry:
+    if name not in to_run: continue
+    result = migration()
+    db.migrations.insert_one({'_id': name, 'appliedAt': datetime.datetime.utcnow(), 'result': result})
+    results['migrations'][name] = result
+  return results
@@ -0,0 +1,23 @@
+import os
+from chalicelib.util import database, cache, metrics
+
+# IdP id -> owning user id. Only owned IdPs are cached: an IdP's owner never changes once set, but unowned IdPs can still be claimed.
+idp_owners = cache.TTLCache(int(os.environ.get('IDP_OWNER_CACHE_SIZE', 4096)), int(os.environ.get('IDP_OWNER_CACHE_TTL', 300)))
+metrics.collect_cache('idpOwners', idp_owners)
+missing = object()
+
+def get_idp_owner(idp_id):
+  owner = idp_owners.get(str(idp_id))
+  if owner is not None: return owner
+  return remember(idp_id, database.get_db().idps.find_one({'_id': idp_id}, {'user': 1}))
+
+def remember(idp_id, idp):
+  if not idp: return missing
+  if idp.get('user'): idp_owners.set(str(idp_id), idp['user'], str(idp['user']))
+  return idp.get('user')
+
+def invalidate_idp(idp_id):
+  idp_owners.invalidate(str(idp_id))
+
+def invalidate_user(user_id):
+  idp_owners.invalidate_group(str(user_id))
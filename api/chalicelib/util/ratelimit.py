@@ -0,0 +1,74 @@
+import os, time, datetime
+from limits.storage import Storage
+from pymongo import ReturnDocument
+from chalicelib.util import database
+
+# Fixed-window rate limit counters in the API's own database, shared by all workers.
+# With RATELIMIT_LOCAL_BATCH above 1, each worker adds up to that many hits locally
+# before sending them to Mongo in a single $inc, trading some accuracy for fewer round trips.
+class MongoStorage(Storage):
+  STORAGE_SCHEME = ['ssotools-mongo']
+
+  def __init__(self, uri=None, **options):
+    super().__init__(uri, **options)
+    self.local_batch = int(os.environ.get('RATELIMIT_LOCAL_BATCH', 1))
+    self.local_interval = float(os.environ.get('RATELIMIT_LOCAL_INTERVAL', 1))
+    self.local = {}
+
+  @property
+  def counters(self):
+    return database.get_db().rateLimits
+
+  def incr(self, key, expiry, elastic_expiry=False, amount=1):
+    if self.local_batch <= 1 or elastic_expiry:
+      return self.increment(key, expiry, elastic_expiry, amount)[0]
+    with self.lock:
+      entry = self.local.get(key)
+      if entry and entry['expireAt'] <= datetime.datetime.utcnow(): entry = None
+      if entry and entry['pending'] + amount < self.local_batch and time.monotonic() - entry['flushedAt'] < self.local_interval:
+        entry['pending'] += amount
+        return entry['count'] + entry['pending']
+      pending = entry['pending'] if entry else 0
+    count, expire_at = self.increment(key, expiry, elastic_expiry, amount + pending)
+    with self.lock:
+      if len(self.local) > 10000: self.prune()
+      self.local[key] = {'count': count, 'pending': 0, 'expireAt': expire_at, 'flushedAt': time.monotonic()}
+    return count
+
+  def increment(self, key, expiry, elastic_expiry, amount):
+    expire_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=expiry)
+    expired = {'$lt': [{'$ifNull': ['$expireAt', None]}, '$$NOW']}
+    counter = self.counters.find_one_and_update({'_id': key}, [{'$set': {
+      'count': {'$cond': [expired, amount, {'$add': ['$count', amount]}]},
+      'expireAt': {'$cond': [expired, expire_at, expire_at if elastic_expiry else '$expireAt']},
+    }}], upsert=True, return_document=ReturnDocument.AFTER)
+    return counter['count'], counter['expireAt']
+
+  def prune(self):
+    now = datetime.datetime.utcnow()
+    for key in [k for k, entry in self.local.items() if entry['expireAt'] <= now]: del self.local[key]
+
+  def get(self, key):
+    counter = self.counters.find_one({'_id': key, 'expireAt': {'$gt': datetime.datetime.utcnow()}})
+    pending = self.local.get(key, {}).get('pending', 0)
+    return (counter['count'] if counter else 0) + pending
+
+  def get_expiry(self, key):
+    counter = self.counters.find_one({'_id': key})
+    expire_at = counter['expireAt'] if counter else datetime.datetime.utcnow()
+    return int(expire_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+  def check(self):
+    try:
+      database.get_db().command('ping')
+      return True
+    except Exception:
+      return False
+
+  def reset(self):
+    with self.lock: self.local.clear()
+    return self.counters.delete_many({}).deleted_count
+
+  def clear(self, key):
+    with self.lock: self.local.pop(key, None)
+    self.counters.delete_one({'_id': key})
@@ -0,0 +1,49 @@
+import os, json, datetime
+from bson.objectid import ObjectId
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+backends = ['orjson', 'json'] if orjson else ['json']
+backend = os.environ.get('JSON_BACKEND', backends[0])
+if backend not in backends: backend = 'json'
+
+def default(obj):
+  if isinstance(obj, (datetime.datetime, datetime.date)):
+    return obj.isoformat()
+  elif isinstance(obj, ObjectId):
+    return str(obj)
+  elif isinstance(obj, bytes):
+    return obj.decode('utf-8', 'replace')
+  raise TypeError('Object of type {0} is not JSON serializable'.format(type(obj).__name__))
+
+class MongoJsonEncoder(json.JSONEncoder):
+  def default(self, obj):
+    try:
+      return default(obj)
+    except TypeError:
+      return json.JSONEncoder.default(self, obj)
+
+def dumps(obj, using=None):
+  if (using or backend) == 'orjson':
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+  return json.dumps(obj, cls=MongoJsonEncoder)
+
+def iter_dumps(obj, using=None):
+  # Encodes lists (including lists directly inside a dict) one item at a time, so large responses can be streamed
+  if isinstance(obj, list):
+    yield '['
+    for i, item in enumerate(obj):
+      yield (',' if i else '') + dumps(item, using)
+    yield ']'
+  elif isinstance(obj, dict):
+    yield '{'
+    for i, (key, value) in enumerate(obj.items()):
+      yield (',' if i else '') + dumps(str(key), using) + ':'
+      if isinstance(value, list): yield from iter_dumps(value, using)
+      else: yield dumps(value, using)
+    yield '}'
+  else:
+    yield dumps(obj, using)
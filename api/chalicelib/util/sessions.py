@@ -0,0 +1,49 @@
+import datetime, hashlib, jwt, os
+from pymongo import UpdateOne
+from chalicelib.util import database
+
+jwt_secret = os.environ.get('JWT_SECRET')
+
+def hash_token(token):
+  return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def create(user_id, token, expires_at):
+  db = database.get_db()
+  db.sessions.update_one(*upsert(user_id, token, expires_at), upsert=True)
+
+def upsert(user_id, token, expires_at):
+  return {'_id': hash_token(token)}, {'$setOnInsert': {'user': user_id, 'createdAt': datetime.datetime.utcnow(), 'expiresAt': expires_at}}
+
+def find(user_id, token):
+  db = database.get_db()
+  return db.sessions.find_one({'_id': hash_token(token), 'user': user_id})
+
+def revoke(token):
+  db = database.get_db()
+  db.sessions.delete_one({'_id': hash_token(token)})
+
+def revoke_user(user_id):
+  db = database.get_db()
+  db.sessions.delete_many({'user': user_id})
+
+def migrate_login_tokens():
+  db = database.get_db()
+  migrated = 0
+  pruned = 0
+  for user in db.users.find({'tokens.login': {'$exists': True}}, {'tokens.login': 1}):
+    operations = []
+    for token in user['tokens'].get('login') or []:
+      try:
+        payload = jwt.decode(token, jwt_secret, algorithms=['HS256'])
+      except jwt.InvalidTokenError:
+        pruned += 1
+        continue
+      operations.append(UpdateOne({'_id': hash_token(token)}, {'$setOnInsert': {
+        'user': user['_id'],
+        'createdAt': datetime.datetime.utcfromtimestamp(payload.get('iat', payload['exp'])),
+        'expiresAt': datetime.datetime.utcfromtimestamp(payload['exp'])
+      }}, upsert=True))
+    if operations: db.sessions.bulk_write(operations, ordered=False)
+    migrated += len(operations)
+    db.users.update_one({'_id': user['_id']}, {'$unset': {'tokens.login': ''}})
+  return {'migrated': migrated, 'pruned': pruned}
@@ -0,0 +1,74 @@
+import os, datetime
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
+from chalicelib.util import database
+
+log_collections = {'saml2': 'requests', 'oauth2': 'oauthRequests'}
+rollup_batch_size = int(os.environ.get('STATS_BATCH_SIZE', 1000))
+# Logs newer than this are left for the next run, so documents inserted slightly out of _id order aren't skipped
+rollup_lag = datetime.timedelta(seconds=int(os.environ.get('STATS_LAG', 60)))
+saml_success = 'urn:oasis:names:tc:SAML:2.0:status:Success'
+
+def is_failure(log):
+  status = log.get('data', {}).get('samlStatusCode')
+  return bool(status) and status != saml_success
+
+def rollup(max_batches=None):
+  db = database.get_db()
+  upper_bound = ObjectId.from_datetime(datetime.datetime.utcnow() - rollup_lag)
+  processed = {}
+  for kind, collection in log_collections.items():
+    state = db.jobState.find_one({'_id': 'stats.' + collection}) or {}
+    last_id = state.get('lastId')
+    # A batch that was started but not checkpointed is read again over exactly the same range, whatever the current upper bound is
+    pending = state.get('pending')
+    processed[kind] = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+      query = {'_id': {'$lte': pending} if pending else {'$lt': upper_bound}}
+      if last_id: query['_id']['$gt'] = last_id
+      logs = list(db[collection].find(query, {'idp': 1, 'sp': 1, 'type': 1, 'createdAt': 1, 'data.samlStatusCode': 1}).sort('_id', pymongo.ASCENDING).limit(0 if pending else rollup_batch_size))
+      if not logs and not pending: break
+      increments = {}
+      for log in logs:
+        created_at = log.get('createdAt') or log['_id'].generation_time.replace(tzinfo=None)
+        key = (log.get('idp'), log.get('sp'), created_at.replace(minute=0, second=0, microsecond=0))
+        counts = increments.setdefault(key, {'requests': 0, 'failures': 0})
+        counts['requests'] += 1
+        counts['types.' + log.get('type', 'unknown')] = counts.get('types.' + log.get('type', 'unknown'), 0) + 1
+        if is_failure(log): counts['failures'] += 1
+      if not pending:
+        pending = logs[-1]['_id']
+        db.jobState.update_one({'_id': 'stats.' + collection}, {'$set': {'pending': pending}}, upsert=True)
+      # Each hour records the end of the last batch counted into it, so when a batch is replayed the hours it already reached are skipped (their upserts hit the unique index)
+      try:
+        if increments: db.idpStats.bulk_write([
+          UpdateOne({'idp': idp, 'hour': hour, 'kind': kind, 'sp': sp, 'lastId': {'$not': {'$gte': pending}}}, {'$inc': counts, '$set': {'lastId': pending}}, upsert=True)
+          for (idp, sp, hour), counts in increments.items()
+        ], ordered=False)
+      except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']): raise
+      db.jobState.update_one({'_id': 'stats.' + collection}, {'$set': {'lastId': pending, 'updatedAt': datetime.datetime.utcnow()}, '$unset': {'pending': ''}}, upsert=True)
+      last_id, pending = pending, None
+      processed[kind] += len(logs)
+      batches += 1
+  return processed
+
+def get_stats(idp_id, since, until, sp=None):
+  db = database.get_read_db()
+  hours = list(db.idpStats.find(stats_query(idp_id, since, until, sp), {'_id': 0, 'idp': 0, 'lastId': 0}).sort('hour', pymongo.ASCENDING))
+  return summarize(hours, since, until)
+
+def stats_query(idp_id, since, until, sp=None):
+  query = {'idp': idp_id, 'hour': {'$gte': since, '$lt': until}}
+  if sp: query['sp'] = sp
+  return query
+
+def summarize(hours, since, until):
+  totals = {kind: {'requests': 0, 'failures': 0} for kind in log_collections}
+  for hour in hours:
+    totals[hour['kind']]['requests'] += hour.get('requests', 0)
+    totals[hour['kind']]['failures'] += hour.get('failures', 0)
+  return {'since': since, 'until': until, 'totals': totals, 'hours': hours}
@@ -1,7 +1,9 @@
-import json, datetime
-from flask import request
+import datetime, calendar, zlib, hashlib, base64, json
+from bson.errors import InvalidId
+from flask import request, g, make_response
 from flask_limiter.util import get_remote_address
 from bson.objectid import ObjectId
+from chalicelib.util import errors, serialization, metrics
 from chalicelib.api import accounts
 
 def get_user(required = True):
@@ -9,22 +11,70 @@ def get_user(required = True):
   if not headers.get('Authorization') and required:
     raise errors.Unauthorized('This resource requires authentication')
   if headers.get('Authorization'):
-    user = accounts.get_user_context(headers.get('Authorization').replace('Bearer ', ''))
+    if 'user' not in g:
+      g.user = accounts.get_user_context(headers.get('Authorization').replace('Bearer ', ''), request.method not in ('GET', 'HEAD'))
+    user = g.user
     if user is None and required:
       raise errors.Unauthorized('Invalid token')
     return user
   return None
 
 def limit_by_client():
-  data = request.get_json()
+  data = request.get_json(silent=True)
   if data:
     if data.get('email'): return data.get('email')
     if data.get('token'): return data.get('token')
   return get_remote_address()
 
 def limit_by_user():
-  user = get_user(required = False)
-  return user['_id'] if user else get_remote_address()
+  # Uses the verified token subject rather than get_user, so rate limiting doesn't need a database read
+  authorization = request.headers.get('Authorization')
+  user_id = accounts.get_token_subject(authorization.replace('Bearer ', '')) if authorization else None
+  return user_id or get_remote_address()
+
+def parse_object_id(value):
+  try:
+    return ObjectId(value)
+  except (InvalidId, TypeError):
+    raise errors.BadRequest('{0} is not a valid ID'.format(value))
+
+def parse_datetime(value):
+  try:
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+  except ValueError:
+    raise errors.BadRequest('{0} is not a valid ISO 8601 date'.format(value))
+  if parsed.tzinfo: parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+  return parsed
+
+def encode_cursor(doc):
+  created_at = doc['createdAt']
+  millis = calendar.timegm(created_at.utctimetuple()) * 1000 + created_at.microsecond // 1000
+  return '{0}_{1}'.format(millis, doc['_id'])
+
+def decode_cursor(cursor):
+  try:
+    millis, id = cursor.split('_')
+    return datetime.datetime.utcfromtimestamp(int(millis) / 1000), ObjectId(id)
+  except (ValueError, InvalidId):
+    raise errors.BadRequest('The cursor is invalid')
+
+def keyset_filter(cursor, operator):
+  created_at, id = decode_cursor(cursor)
+  return {'$or': [{'createdAt': {operator: created_at}}, {'createdAt': created_at, '_id': {operator: id}}]}
+
+def encode_sort_cursor(field, doc):
+  return base64.urlsafe_b64encode(json.dumps([field, doc.get(field), str(doc['_id'])]).encode('utf-8')).decode('ascii')
+
+def sort_key_filter(field, cursor):
+  # Matches the documents after the cursor in an ascending (field, _id) sort, where missing values sort first
+  try:
+    cursor_field, value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    id = ObjectId(id)
+  except (ValueError, TypeError, InvalidId):
+    raise errors.BadRequest('The cursor is invalid')
+  if cursor_field != field: raise errors.BadRequest('The cursor belongs to a different sort order')
+  if value is None: return {'$or': [{field: None, '_id': {'$gt': id}}, {field: {'$ne': None}}]}
+  return {'$or': [{field: {'$gt': value}}, {field: value, '_id': {'$gt': id}}]}
 
 def filter_keys(obj, allowed_keys):
   filtered = {}
@@ -46,13 +96,31 @@ def build_updater(obj, allowed_keys):
       updater['$set'][key] = allowed[key]
   return updater
 
-class MongoJsonEncoder(json.JSONEncoder):
-  def default(self, obj):
-    if isinstance(obj, (datetime.datetime, datetime.date)):
-      return obj.isoformat()
-    elif isinstance(obj, ObjectId):
-      return str(obj)
-    return json.JSONEncoder.default(self, obj)
+def ndjson(items):
+  for item in items:
+    yield serialization.dumps(item) + '\n'
+
+def gzip_stream(chunks):
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+  for chunk in chunks:
+    compressed = compressor.compress(chunk.encode('utf-8'))
+    if compressed: yield compressed
+  yield compressor.flush()
 
 def jsonify(*args, **kwargs):
-  return json.dumps(dict(*args, **kwargs), cls=MongoJsonEncoder)
+  with metrics.timer('jsonify'):
+    return serialization.dumps(dict(*args, **kwargs))
+
+def jsonify_stream(*args, **kwargs):
+  return serialization.iter_dumps(dict(*args, **kwargs))
+
+def etag(*parts):
+  return hashlib.sha1(serialization.dumps(list(parts)).encode('utf-8')).hexdigest()
+
+def conditional(tag, build):
+  # Answers If-None-Match before the response body is built
+  if request.if_none_match.contains(tag):
+    response = make_response('', 304)
+  else: response = make_response(build())
+  response.set_etag(tag)
+  return response
@@ -0,0 +1,41 @@
+# Settings for serving the API with `gunicorn app:app` (gunicorn reads this file from the working directory)
+import os, shutil, tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# The app is imported once in the master and shared by the forked workers. Mongo clients, the hashing pool and background threads are per process, so each worker creates its own.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+# Workers share one socket, so a scrape reaches any of them. Each worker writes its metrics to this directory and /metrics reports the totals of all of them.
+created_metrics_dir = None
+if not os.environ.get('METRICS_DIR'):
+  created_metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='ssotools-metrics-')
+
+def on_starting(server):
+  from chalicelib.util import metrics
+  metrics.clear()
+
+def on_exit(server):
+  if created_metrics_dir: shutil.rmtree(created_metrics_dir, ignore_errors=True)
+
+def when_ready(server):
+  # The master never serves requests, so it doesn't keep the connection opened while importing the app
+  from chalicelib.util import database
+  database.close()
+
+def post_worker_init(worker):
+  # Runs in each worker after the app is loaded and before it accepts requests
+  from chalicelib.util import database, hashing, mail, metrics
+  from chalicelib.api import accounts
+  if os.environ.get('MONGO_WARM_UP', 'true').lower() == 'true': database.warm_up()
+  hashing.warm_up()
+  if mail.background_delivery: mail.start_worker()
+  metrics.start_writer()
+  try:
+    worker.log.info('Warmed {0} cached user sessions'.format(accounts.warm_user_cache()))
+  except Exception as e:
+    worker.log.warning('Unable to warm the user cache: {0}'.format(e))
+
+def worker_exit(server, worker):
+  from chalicelib.util import database, last_seen, metrics
+  last_seen.flush()
+  if metrics.metrics_dir: metrics.write()
+  database.close()
@@ -0,0 +1,33 @@
+# A stand-in for the Mailgun messages endpoint, for testing the mail outbox locally.
+# Run from the api directory with: python tools/fake_mail.py --port 6003 [--delay 2] [--fail-rate 0.3]
+# then set MAILGUN_URL=http://localhost:6003/messages and MAILGUN_KEY to any value.
+import argparse, random, time
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+messages = []
+options = {'delay': 0, 'fail_rate': 0}
+
+@app.route('/messages', methods=['POST'])
+def receive():
+  time.sleep(options['delay'])
+  if random.random() < options['fail_rate']:
+    return jsonify({'message': 'Simulated failure'}), 503
+  message = request.form.to_dict(flat=False)
+  messages.append(message)
+  print('Received message for {0}: {1}'.format(', '.join(message.get('to', [])), message.get('subject')))
+  return jsonify({'id': '<{0}@fake.mail>'.format(len(messages)), 'message': 'Queued. Thank you.'})
+
+@app.route('/messages', methods=['GET'])
+def list_messages():
+  return jsonify({'messages': messages})
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=6003)
+  parser.add_argument('--delay', type=float, default=0)
+  parser.add_argument('--fail-rate', type=float, default=0)
+  args = parser.parse_args()
+  options['delay'] = args.delay
+  options['fail_rate'] = args.fail_rate
+  app.run(port=args.port)